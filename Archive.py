@@ -19,10 +19,9 @@
 #		The normal operation of running the command is to
 #		archive all tracked files in this directory and in
 #		any subdirectories that have a repository, recursively.
-#		Currently "all tracked files" means "all files" in
-#		the directory, including binary files. If you don't
-#		want that behaviour, move into another directory those
-#		files you don't want tracked.
+#		Unless a config file (see below) says otherwise,
+#		"all tracked files" means "all files" in the directory,
+#		including binary files.
 #
 #  Archive.py *.c *.h
 #
@@ -33,9 +32,54 @@
 #		be a list of matching files. It may not work in M$-Windows
 #		because the shell there may not automatically expand globs.
 #
+#  Archive.py -j N
+#
+#		Archive using N worker threads, so files are hashed and
+#		stored, and subdirectories archived, in parallel.
+#		The result is the same as archiving with one thread.
+#
+#  Archive.py watch
+#
+#		Archive everything as above, then keep running, and
+#		archive again whenever something changes (see Watch mode).
+#
 # Commands:
 #
 # init                      Create a repository here if not already extant.
+# repack [--lzma]           Move old versions into a compressed packfile.
+# checkout <rev>            Check out a specific revision.
+# checkout <name> <rev>     Check out a specific revision of a specific file.
+# verify [--fast]           Check every stored version against its hash.
+# gc                        Delete versions beyond the config file's limits.
+# watch                     Archive again whenever anything changes.
+# log <name>                List the archived versions of a file or directory.
+# log --since <t> --until <t>  List versions archived between those times.
+#
+# A revision is either a timestamp, YyyyymmddThhmmssZ or any leading
+# part of one such as Yyyyymmdd (meaning the end of that day), giving
+# what was archived as of then; or a hash (or leading part of one)
+# of a directory, or of the file being checked out.
+# Checking out a directory restores every file and repository-holding
+# subdirectory listed in that revision of it, using "-j N" threads.
+# Files not in that revision are left alone. A file which differs from
+# its latest archived version isn't overwritten, unless --force is given.
+#
+# Logging lists versions newest first, one per line, giving the time
+# of the archiving run which stored it, its version timestamp, size,
+# hash and name. A name is a file, or a directory holding a repository.
+# --since and --until (either, both, and with or without a name) take
+# a timestamp or leading part of one, as for checkout; without a name,
+# every version stored in this directory's repository in that time is
+# listed. Each name's versions are found by following the manifest's
+# links back from its latest version, and times by binary searching
+# the manifest, so the cost depends on how many versions are listed.
+#
+# Verifying reconstructs every version listed in the manifests of this
+# repository and those sharing its object store, and checks its hash
+# and size, and that each directory summary's first line gives the
+# hash of the rest of it. Corrupt and missing versions are reported.
+# The work is spread over "-j N" processes (by default, one per CPU).
+# With --fast, only versions stored since the last verify are checked.
 #
 # Commands not yet implemented:
 #
@@ -44,8 +88,6 @@
 # forget <name>             Ensure a specified file isn't tracked.
 # checkin                   Record changes of everything tracked here and down.
 # checkin <name>            Record what changed in a specific tracked file/dir.
-# checkout <rev>            Check out a specific revision.
-# checkout <name> <rev>     Check out a specific revision of a specific file.
 #
 # When checking in:
 #
@@ -53,13 +95,14 @@
 # the file about to be checked in, that file isn't copied.
 # Otherwise, the file is copied into the repository.
 #
-# Timestamps in the repository use an ISO 8601 basic format.
-# YyyyymmddThhmmssZ_filename...
+# Timestamps in the manifest use an ISO 8601 basic format.
+# YyyyymmddThhmmssZ
 # First the letter Y appears, then year, month, and day numbers,
 # then the letter T, then the hour, minutes, and seconds numbers,
-# then the letter Z, denoting UTC time, then an underscore.
-# Following that is the original file's filename.
+# then the letter Z, denoting UTC time.
 # (Note there is a Y10K bug inherent in this naming scheme.)
+# Older repositories named each version's file with its timestamp,
+# an underscore, and the original filename; see Manifest below.
 #
 # Changeset structure:
 #
@@ -70,51 +113,203 @@
 # are checked in first, and their hashes accumulated before checking in
 # closer to the root.
 #
-# TO DO:
+# Hashes name blobs in the object store, detect changed files,
+# identify revisions to check out, and check the repository's integrity.
 #
-# There's no way to input a checkin message, and no way to store such
-# a message in any case. This may be needed one day to support checkout.
+# Object store:
 #
-# There's no way to check out files. You'd have to manually hunt
-# through the repo for a file or substring you want (e.g. using grep).
+# File contents and directory summaries are stored once each, named
+# by their hash, in .Archive/objects/ of the outermost repository
+# (the highest directory in an unbroken chain of parent directories
+# that each hold a repository). E.g. a blob whose hash is "AbCd..."
+# is stored as .Archive/objects/Ab/Cd...
+# Identical content in different files, in different directories,
+# or reverted to an earlier version, is therefore only stored once.
 #
-# When copying a modified file into the repository:
-# The previous version of the file could be replaced by a
-# reverse delta. This would save space, and allow recent
-# versions to be reconstructed quickly by applying the
-# deltas to the most current version of the file.
-# Some common sense is needed to handle large binary files.
-# 
-# Currently hashes are only computed, not yet used to name revisions.
-# Since there's currently no way to check out, hashes are not yet used.
-# They could in theory also be used to provide an integrity check of
-# the repository.
+# While archiving, blobs are stored by a writer thread, in the order
+# they're found, so files are read and hashed while earlier ones are
+# written. Up to WRITER_QUEUE_SIZE wait to be stored; beyond that,
+# reading waits for writing. Whatever is waiting is stored as a batch:
+# each new file (blob, delta or list of chunks) is written under a
+# temporary name, then they're all fsync'ed, then renamed, then their
+# directories are fsync'ed (except on Windows), and only then are any
+# files they replace removed. So a file under its final name is
+# complete even after a crash. Each directory's manifest is only saved
+# once the versions it lists are stored in this way.
+#
+# Reverse deltas:
+#
+# When a new version of a file is stored, the previous version's blob
+# is replaced by a reverse delta: the instructions for reconstructing
+# it from the new version. This saves space, and recent versions can
+# be reconstructed quickly by applying deltas to the current version.
+# A delta is stored beside where its blob would be, with ".delta" added
+# to the name. It starts with a line naming the blob it's applied to.
+# To bound how many deltas must be applied to reconstruct a version,
+# every DELTA_KEYFRAME'th version of a file is left as a full copy.
+# Large files (over DELTA_MAX_SIZE bytes) are always kept in full,
+# as are versions whose delta isn't smaller than the version itself.
+# Deltas are made once a run's manifests are saved, and a blob which
+# is still the latest version of any name, in any repository sharing
+# the object store (e.g. an identical copy of the file), is left alone.
+#
+# So that needn't read every repository's manifest, the object store's
+# file latestcounts lists each such blob's hash and how many names it's
+# the latest version of, kept up to date as new versions are stored.
+# It's removed while a run changes it and written again at its end, so
+# if it's missing (e.g. after a crash), or a repository joined the store
+# (see merge_object_store() and import_versions()), it's rebuilt from
+# every manifest, once the run's own manifests are saved.
+#
+# Chunked storage:
+#
+# Large files which change a little at a time, like disk images and
+# databases, can be stored as chunks (see Chunk in Config file below).
+# Each file above the size threshold is split into chunks averaging a
+# megabyte, at points chosen by a rolling hash of its content, so an
+# insertion or deletion only changes the chunks around it. Each chunk
+# is stored as a blob, and the file as a list of its chunks' hashes
+# and sizes, beside where its blob would be, with ".chunks" added to
+# the name. So only the chunks which changed take up more space.
+# Splitting is done in Python, hashing blocks of bytes at once with big
+# integers (see find_chunk_end()), but files are still only stored this
+# way at 10 to 20 megabytes per second. So Chunk is impractical for
+# multi-gigabyte files: each time a 20 GB disk image changes, storing it
+# again takes around half an hour.
+#
+# Packfiles:
+#
+# Blobs and deltas are written as separate files ("loose objects").
+# The repack command moves those which aren't the latest version of
+# anything into a new packfile, .Archive/objects/packs/pack-*.pack,
+# each one compressed with zlib (or with lzma, given --lzma).
+# Packfiles are never changed once written. Each has an index file,
+# pack-*.idx, listing its objects sorted by hash, with their offsets
+# and lengths in the packfile, in fixed-size records so it can be
+# memory-mapped and binary searched. Loose objects are looked for
+# before packed objects, and new versions are always stored loose.
+#
+# Manifest:
+#
+# Each repository lists the versions stored there in .Archive/manifest.
+# It is only ever appended to, one line per version, in the order the
+# versions were archived:
 #
-# There's currently no config file.
-# If there was a config file, it could contain a few options:
+#   run version hash size prev name
+#
+# run is the timestamp of the archiving run which stored the version,
+# version is its timestamp (see above: modification time for files,
+# run time for directories), hash names the blob, size is its length,
+# prev is the byte offset in the manifest of the line for the previous
+# version of the same name (-1 if none), and name is the filename.
+# .Archive/latest holds the latest version of each name, so archiving
+# needn't read the whole history. Its first line gives the length of
+# the manifest it reflects; any later manifest lines are replayed.
+# A name's older versions are found by following prev back from its
+# latest, reading only that name's lines. So finding the version as of
+# a time (as checkout does) costs a seek per version of the name since
+# then: there's no index of a name's versions by time to binary search,
+# since keeping one would mean rewriting more than the manifest's end.
+#
+# Repositories made before the manifest existed instead held a file
+# (or a symbolic link into the object store) for each version, named
+# YyyyymmddThhmmssZ_filename. These are imported into the manifest,
+# and full copies moved into the object store, the first time such a
+# repository is archived. The manifest is then authoritative, so the
+# old files and links are removed once it's saved.
+#
+# Stat cache:
+#
+# Each repository keeps a file .Archive/statcache holding the size,
+# modification time (in nanoseconds), inode, mode and hash of each
+# file archived there. A file whose stat results match its cached
+# entry is assumed unchanged, so it is neither read nor hashed, and
+# its latest repository version isn't examined either. Files modified
+# very shortly before the cache is written aren't cached, since a
+# further modification within the same clock tick could go unnoticed.
+#
+# Tree cache:
+#
+# When a subdirectory holding a repository is archived, its summary is
+# saved in its .Archive/treecache, along with the stat results of every
+# entry the summary covers: the subdirectory itself, its files and
+# subdirectories, and recursively everything covered by the summaries
+# of subdirectories holding repositories. Adding, removing or renaming
+# an entry changes its directory's modification time, so if all those
+# stat results are unchanged, so is the summary. Then that subdirectory
+# is skipped entirely: nothing in it is listed, read or loaded again.
+#
+# Watch mode:
+#
+# The watch command watches this directory and every subdirectory
+# archived with it, using Linux inotify (or, where that's unavailable,
+# by listing and stat'ing their entries every WATCH_POLL_INTERVAL
+# seconds). Changes are gathered until none arrive for WATCH_DEBOUNCE
+# seconds (or for at most WATCH_MAX_DELAY seconds), then archived.
+# Only the directories where something changed, and those above them,
+# are examined: every other subdirectory's tree cache is trusted
+# without checking its stat results. New subdirectories are watched
+# once their parent is next archived. inotify doesn't report a
+# repository being made in an existing subdirectory, so that's only
+# noticed once something else changes in the subdirectory's parent.
+# A change to the config file is picked up before the next archiving.
+#
+# Config file:
+#
+# A config file named .Archive.cfg in the current working directory
+# is read once when Archive.py starts, and applies to every directory
+# archived. Each line is one of the following, where the pattern is a
+# glob matched against filenames. Blank lines and lines starting with
+# # are ignored. The first line whose pattern matches a name decides
+# what happens to it.
 #
 # Retain: N pattern
 # Retain followed by a decimal number and then a pattern
 # indicates that only the last N instances matching that pattern
-# will be kept in the repository (older instances are auto-deleted!)
-# The purpose of this feature is to allow _some_ binary files to be kept,
-# while still keeping the size of the repository manageable.
-# N could be optional, so the default usage "Retain: pattern" would
-# be used to signify a white list of files to keep, e.g. "Retain: *.py".
+# will be kept in the repository (older instances are deleted by
+# the gc command!) The purpose of this feature is to allow _some_
+# binary files to be kept, while still keeping the size of the
+# repository manageable.
+# N is optional, so the usage "Retain: pattern" signifies a white list
+# of files to keep, e.g. "Retain: *.py". If there are any Retain lines,
+# only files matching one of them are tracked.
 #
 # Ignore: pattern
-# Ignore certain glob patterns (and/or perhaps regular expressions).
+# Ignore files and subdirectories matching a glob pattern.
 # E.g. "Ignore: *.exe"
+# They're skipped without even being stat'ed.
+#
+# Chunk: N
+# Store files larger than N bytes as chunks (see Chunked storage above).
+# This isn't a pattern, so applies whatever line matches a name.
+#
+# Files named on the command line are archived regardless.
+# Patterns are compiled into a single regular expression, so each name
+# is matched against all of them at once.
 #
+# gc deletes versions beyond the Retain limits from every manifest
+# sharing the object store, then deletes every blob, loose or packed,
+# which is no longer the version of anything (nor needed to rebuild one).
+#
+# TO DO:
+#
+# There's no way to input a checkin message, and no way to store such
+# a message in any case. This may be needed one day to support checkout.
+
 
-import os, sys, string, time, stat
-import base64, hashlib
+import os, sys, string, time, stat, threading
+import base64, concurrent.futures, ctypes, ctypes.util, fnmatch, hashlib, lzma, mmap, queue, re, select, shutil, struct, zlib
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
 
 USING_LINUX = (os.sep == '/')
 
 PROGRAM_NAME =       "Archive"
 THIS_PROGRAM =       PROGRAM_NAME + ".py"
 REPO_DIRNAME = "." + PROGRAM_NAME + "/"
+OBJECTS_DIR  = "objects/"
 CONFIG_FILE  = "." + PROGRAM_NAME + ".cfg"
 
 DIR_NAME     = "."
@@ -122,9 +317,16 @@ DIR_NAME     = "."
 COMMANDS_INIT       = ["init"]
 COMMANDS_ADD        = ["add"]
 COMMANDS_ADDSUFFIX  = ["addsuffix"]
+COMMANDS_REPACK     = ["repack"]
+COMMANDS_CHECKOUT   = ["checkout"]
+COMMANDS_VERIFY     = ["verify"]
+COMMANDS_GC         = ["gc"]
+COMMANDS_WATCH      = ["watch"]
+COMMANDS_LOG        = ["log"]
 
 CONFIG_RETAIN       = 'Retain'
 CONFIG_IGNORE       = 'Ignore'
+CONFIG_CHUNK        = 'Chunk'
 
 EXAMPLE_CONFIG_FILE = '''
 Retain: *.c
@@ -138,6 +340,54 @@ Ignore: *.exe
 TIMESTAMP_FORMAT = "Y%Y%m%dT%H%M%SZ_"
 TIMESTAMP_LENGTH = 18
 
+CHUNK_SIZE       = 1024 * 1024	# Bytes read at a time from large files.
+KERNEL_COPY_SIZE = 1 << 30		# Bytes copied at a time within the kernel.
+FICLONE          = 0x40049409	# Linux ioctl to clone a file's data blocks.
+
+DELTA_SUFFIX     = ".delta"
+DELTA_HEADER     = b"Archive delta "
+DELTA_KEYFRAME   = 16				# Every Nth version is stored in full.
+DELTA_MAX_SIZE   = 16 * 1024 * 1024	# Larger versions are stored in full.
+DELTA_MAX_DEPTH  = 10000			# More than this implies a damaged store.
+DELTA_MIN_COPY   = 32				# Shorter runs are inserted rather than copied.
+
+WRITER_QUEUE_SIZE = 64				# Most blobs waiting to be stored.
+STORE_ATTEMPTS    = 3				# Times a file changing as it's stored is reread.
+
+CHUNKS_SUFFIX    = ".chunks"
+CHUNKS_HEADER    = b"Archive chunks\n"
+CDC_MIN_CHUNK    = 256 * 1024		# Chunks are at least this big,
+CDC_MAX_CHUNK    = 4 * 1024 * 1024	# and at most this big,
+CDC_BITS         = 20				# and average the minimum plus 2**CDC_BITS.
+CDC_GEAR = [int.from_bytes(hashlib.sha384(bytes([i])).digest()[:4], "big") for i in range(256)]
+CDC_MASK         = ((1 << CDC_BITS) - 1) << (32 - CDC_BITS)
+CDC_GEAR_BYTES   = [bytes(gear >> (8 * j) & 0xFF for gear in CDC_GEAR) for j in range(4)]
+CDC_MASK_BYTES   = [bytes(b & (CDC_MASK >> (8 * j)) & 0xFF for b in range(256)) for j in range(4)]
+CDC_SLOT         = 9				# Bytes per hash when hashing a block at once.
+CDC_BLOCK        = 32 * 1024		# Bytes hashed at once.
+
+PACKS_DIR        = "packs/"
+PACK_HEADER      = b"Archive pack 1\n"
+PACK_IDX_HEADER  = b"Archive pack index 1\n"
+PACK_IDX_RECORD  = ">48sQQcc"			# Hash, offset, length, kind, compression.
+PACK_MAX_SIZE    = 64 * 1024 * 1024	# Larger objects are left loose.
+
+MANIFEST_FILE    = "manifest"
+LATEST_FILE      = "latest"
+STATCACHE_FILE   = "statcache"
+STATCACHE_RACY_NS = 2 * 1000 * 1000 * 1000
+TREECACHE_FILE   = "treecache"
+VERIFIED_FILE    = "verified"
+LATEST_COUNTS_FILE = "latestcounts"
+
+WATCH_DEBOUNCE       = 0.5		# Seconds without changes before archiving.
+WATCH_MAX_DELAY      = 5.0		# Most seconds to keep gathering changes.
+WATCH_POLL_INTERVAL  = 2.0		# Seconds between polls, without inotify.
+WATCH_MASK           = 0x01000FCE	# inotify: IN_ONLYDIR and changes to entries.
+WATCH_EVENT          = "iIII"		# inotify_event: wd, mask, cookie, len.
+WATCH_OVERFLOW       = 0x4000		# inotify: IN_Q_OVERFLOW.
+WATCH_IGNORED        = 0x8000		# inotify: IN_IGNORED, the watch is gone.
+
 
 def main():
 	handle_args(sys.argv)
@@ -147,6 +397,13 @@ def handle_args(args):
 	subdirs_to_archive = []
 	files_to_archive   = []
 
+	args, jobs = get_jobs_option(args)
+	if jobs is None:
+		return
+	config = read_config(CONFIG_FILE)
+	if config is None:
+		return
+
 	for arg in args[1:]:
 		handled = 0
 
@@ -162,6 +419,99 @@ def handle_args(args):
 		if handled:
 			return
 
+		# "repack" command: move old versions into a packfile.
+		if arg in COMMANDS_REPACK:
+			if not repo_exists(repository):
+				sys.stderr.write(THIS_PROGRAM + ": error: no repository here, use init command first\n")
+				return
+			compression = b"z"
+			for option in args[args.index(arg)+1:]:
+				if option == "--lzma":
+					compression = b"x"
+				else:
+					sys.stderr.write(THIS_PROGRAM + ": error: unknown repack option " + option + "\n")
+					return
+			repack(repository, find_object_store(repository), compression)
+			return
+
+		# "checkout" command: restore a revision of a directory or file.
+		if arg in COMMANDS_CHECKOUT:
+			if not repo_exists(repository):
+				sys.stderr.write(THIS_PROGRAM + ": error: no repository here, use init command first\n")
+				return
+			params = args[args.index(arg)+1:]
+			force = "--force" in params
+			params = [param for param in params if param != "--force"]
+			if len(params) == 1:
+				if checkout_dir(".", repository, params[0], find_object_store(repository), Workers(jobs), force):
+					sys.exit(1)
+			elif len(params) == 2:
+				if checkout_file(params[0], repository, params[1], find_object_store(repository), force):
+					sys.exit(1)
+			else:
+				sys.stderr.write(THIS_PROGRAM + ": error: usage: checkout [--force] [name] rev\n")
+			return
+
+		# "verify" command: check the integrity of the repository.
+		if arg in COMMANDS_VERIFY:
+			if not repo_exists(repository):
+				sys.stderr.write(THIS_PROGRAM + ": error: no repository here, use init command first\n")
+				return
+			fast = 0
+			for option in args[args.index(arg)+1:]:
+				if option == "--fast":
+					fast = 1
+				else:
+					sys.stderr.write(THIS_PROGRAM + ": error: unknown verify option " + option + "\n")
+					return
+			if verify(repository, find_object_store(repository), jobs or os.cpu_count() or 1, fast):
+				sys.exit(1)
+			return
+
+		# "gc" command: delete versions beyond the config file's limits.
+		if arg in COMMANDS_GC:
+			if not repo_exists(repository):
+				sys.stderr.write(THIS_PROGRAM + ": error: no repository here, use init command first\n")
+				return
+			gc(repository, find_object_store(repository), config)
+			return
+
+		# "watch" command: archive again whenever anything changes.
+		if arg in COMMANDS_WATCH:
+			if not repo_exists(repository):
+				sys.stderr.write(THIS_PROGRAM + ": error: no repository here, use init command first\n")
+				return
+			watch(repository, find_object_store(repository), Workers(jobs), Writer(), config)
+			return
+
+		# "log" command: list archived versions.
+		if arg in COMMANDS_LOG:
+			if not repo_exists(repository):
+				sys.stderr.write(THIS_PROGRAM + ": error: no repository here, use init command first\n")
+				return
+			params = args[args.index(arg)+1:]
+			name = None
+			since = None
+			until = None
+			while params:
+				param = params.pop(0)
+				if param in ("--since", "--until") and params and is_timestamp(params[0]):
+					if param == "--since":
+						since = params.pop(0)
+					else:
+						until = params.pop(0)
+				elif param[:2] != "--" and name is None:
+					name = param
+				else:
+					sys.stderr.write(THIS_PROGRAM + ": error: usage: log [name] [--since time] [--until time]\n")
+					return
+			if name is None and since is None and until is None:
+				sys.stderr.write(THIS_PROGRAM + ": error: usage: log [name] [--since time] [--until time]\n")
+				return
+			if log(name, repository, since, until, find_object_store(repository)):
+				sys.exit(1)
+			return
+
 		# "add" command: add to the list of files to be tracked.
 		# TO DO
 		# Currently there is no need for an add command because
@@ -188,15 +538,8 @@ def handle_args(args):
 		if handled:
 			continue
 
-		# Parse config file.
-		# TO DO
-		# Currently there is no need for a config file because
-		# all files in the current working directory are assumed
-		# to be in the set of files to be tracked and archived.
-		# I.e: keep files you don't want tracked in another directory.
-
-		# In lieu of a config file listing what to track,
-		# all files in this directory are tracked.
+		# Files named on the command line are tracked,
+		# whatever the config file says.
 		if is_regular_file(arg) and not is_readable_file(arg):
 			sys.stderr.write(THIS_PROGRAM + ": error: could not open file named " + arg + "\n")
 			continue
@@ -214,15 +557,219 @@ def handle_args(args):
 		sys.stderr.write(THIS_PROGRAM + ": error: no repository here, use init command first\n")
 		return
 
+	statuses = {}
 	if not files_to_archive:
-		subdirs_to_archive, files_to_archive = list_dir_sorted(".")
+		subdirs_to_archive, files_to_archive = list_dir_sorted(".", config, statuses)
+
+	now = time.strftime(TIMESTAMP_FORMAT, time.gmtime())
+	store = find_object_store(repository)
+	writer = Writer()
+	archive(".", repository, subdirs_to_archive, files_to_archive, now, store, Workers(jobs), writer, config, statuses = statuses)
+	writer.store_deltas(repository)
+
+# Remove any "-j N" (or "-jN") option from the arguments.
+# Return the remaining arguments, and the number of jobs
+# (0 if not specified, or None if it wasn't understood).
+def get_jobs_option(args):
+	jobs = 0
+	remaining = []
+	i = 0
+	while i < len(args):
+		arg = args[i]
+		i += 1
+		if arg[:2] != "-j" or i == 1:
+			remaining.append(arg)
+			continue
+		value = arg[2:]
+		if not value and i < len(args):
+			value = args[i]
+			i += 1
+		try:
+			jobs = int(value)
+		except ValueError:
+			jobs = 0
+		if jobs < 1:
+			sys.stderr.write(THIS_PROGRAM + ": error: bad number of jobs " + value + "\n")
+			return remaining, None
+	return remaining, jobs
 
+# Archive this directory, then watch it and its subdirectories holding
+# repositories, and archive again whenever they change (see Watch mode).
+# Runs until interrupted.
+def watch(repo, store, workers, writer, config):
+	statuses = {}
+	subdirs, filenames = list_dir_sorted(".", config, statuses)
 	now = time.strftime(TIMESTAMP_FORMAT, time.gmtime())
-	archive(".", repository, subdirs_to_archive, files_to_archive, now)
+	archive(".", repo, subdirs, filenames, now, store, workers, writer, config, statuses = statuses)
+	writer.store_deltas(repo)
+
+	watcher = Watcher(repo)
+	for dirpath in find_watch_dirs(".", repo, config):
+		watcher.add(dirpath)
+	sys.stdout.write(THIS_PROGRAM + ": watching %d directories%s\n" % (len(watcher.dirs), "" if watcher.fd is not None else " by polling"))
+	config_fingerprint = get_path_fingerprint(CONFIG_FILE)
+	try:
+		while True:
+			# Gather changes until they stop for a moment.
+			changed = watcher.wait(None)
+			started = time.time()
+			while time.time() - started < WATCH_MAX_DELAY:
+				more = watcher.wait(WATCH_DEBOUNCE)
+				if not more:
+					break
+				changed.update(more)
+
+			# The config file affects what's tracked everywhere.
+			fingerprint = get_path_fingerprint(CONFIG_FILE)
+			if fingerprint != config_fingerprint:
+				config_fingerprint = fingerprint
+				new_config = read_config(CONFIG_FILE)
+				if new_config is not None:
+					config = new_config
+
+			# Everything above a change has a changed summary.
+			dirty = set()
+			for dirpath in changed:
+				while dirpath not in dirty:
+					dirty.add(dirpath)
+					dirpath = os.path.dirname(dirpath) or "."
+
+			statuses = {}
+			subdirs, filenames = list_dir_sorted(".", config, statuses)
+			now = time.strftime(TIMESTAMP_FORMAT, time.gmtime())
+			archive(".", repo, subdirs, filenames, now, store, workers, writer, config, None, dirty, statuses)
+			writer.store_deltas(repo)
+
+			# Watch subdirectories which appeared where things changed.
+			for dirpath in changed:
+				if os.path.isdir(dirpath):
+					for subdirpath in find_watch_dirs(dirpath, repo, config):
+						if subdirpath not in watcher.dirs:
+							watcher.add(subdirpath)
+	except KeyboardInterrupt:
+		pass
+
+# Return the path of the directory dirpath and of every subdirectory
+# which would be archived with it, i.e. reached through directories
+# which all hold repositories.
+def find_watch_dirs(dirpath, repo, config):
+	dirpaths = [dirpath]
+	subdirs, filenames = list_dir_sorted(dirpath, config)
+	for name in subdirs:
+		subdirpath = dirpath + "/" + name
+		if name != repo[:-1] and os.path.isdir(subdirpath + "/" + repo):
+			dirpaths.extend(find_watch_dirs(subdirpath, repo, config))
+	return dirpaths
+
+# Return the stat fingerprint of path, or None if it's not there.
+def get_path_fingerprint(path):
+	try:
+		return get_fingerprint(os.stat(path))
+	except OSError:
+		return None
+
+# Watches directories for changes to their entries: with Linux
+# inotify if it's available, else by polling their stat results.
+class Watcher:
+	def __init__(self, repo):
+		self.repo = repo[:-1]	# Changes in repositories aren't of interest.
+		self.dirs = {}			# Path -> inotify watch, or entries' fingerprints.
+		self.paths = {}			# inotify watch -> path.
+		self.fd = None
+		try:
+			self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+			fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+			if fd >= 0:
+				self.fd = fd
+		except (OSError, AttributeError):
+			pass	# Not Linux, so poll.
+
+	# Start watching the directory dirpath.
+	def add(self, dirpath):
+		if self.fd is None:
+			self.dirs[dirpath] = self.list_fingerprints(dirpath)
+			return
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+		if wd < 0:
+			sys.stderr.write(THIS_PROGRAM + ": error: could not watch " + dirpath + ": " + os.strerror(ctypes.get_errno()) + "\n")
+			return
+		self.dirs[dirpath] = wd
+		self.paths[wd] = dirpath
+
+	# Wait up to timeout seconds (forever if None) for changes.
+	# Return the set of paths of directories whose entries changed.
+	def wait(self, timeout):
+		if self.fd is None:
+			while True:
+				time.sleep(WATCH_POLL_INTERVAL if timeout is None else timeout)
+				changed = self.poll()
+				if changed or timeout is not None:
+					return changed
+		changed = set()
+		readable, writable, failed = select.select([self.fd], [], [], timeout)
+		if not readable:
+			return changed
+		data = os.read(self.fd, 64 * 1024)
+		header = struct.calcsize(WATCH_EVENT)
+		pos = 0
+		while pos + header <= len(data):
+			wd, mask, cookie, length = struct.unpack(WATCH_EVENT, data[pos:pos+header])
+			name = os.fsdecode(data[pos+header:pos+header+length].rstrip(b"\0"))
+			pos += header + length
+			if mask & WATCH_OVERFLOW:
+				changed.update(self.dirs)	# Events were lost.
+				continue
+			dirpath = self.paths.get(wd)
+			if dirpath is None:
+				continue
+			if mask & WATCH_IGNORED:
+				del self.paths[wd]
+				del self.dirs[dirpath]
+			if name != self.repo:
+				changed.add(dirpath)
+		return changed
+
+	# Return the set of paths of watched directories whose entries'
+	# stat results have changed since last polled.
+	def poll(self):
+		changed = set()
+		for dirpath in list(self.dirs):
+			fingerprints = self.list_fingerprints(dirpath)
+			if fingerprints != self.dirs[dirpath]:
+				changed.add(dirpath)
+				self.dirs[dirpath] = fingerprints
+			if fingerprints is None:
+				del self.dirs[dirpath]
+		return changed
+
+	# Return {name: stat fingerprint} of the directory's entries,
+	# or None if it can't be listed.
+	def list_fingerprints(self, dirpath):
+		try:
+			names = os.listdir(dirpath)
+		except OSError:
+			return None
+		fingerprints = {}
+		for name in names:
+			if name != self.repo:
+				fingerprints[name] = get_path_fingerprint(dirpath + "/" + name)
+		return fingerprints
 
 # Archive the named subdirs and filenames.
-# Return the hash of this directory.
-def archive(root, repo, subdirs, filenames, now):
+# Blobs are kept in the object store directory named by store.
+# Subdirectories and files are handled by the given workers,
+# in parallel if there's more than one worker, and blobs are
+# stored by the given writer.
+# If covered is given, it's extended with the (path, stat fingerprint)
+# of every entry the summary depends on (see Tree cache above),
+# or with None if something couldn't be archived.
+# If dirty is given, it's the set of paths of the only subdirectories
+# which may have changed, so others' tree caches are trusted unchecked.
+# If statuses is given, it maps names (including "." for root) to
+# their stat results from listing the directory, so they aren't
+# stat'ed again; anything else is stat'ed when it's archived.
+# Return the summary of this directory.
+def archive(root, repo, subdirs, filenames, now, store, workers, writer, config, covered = None, dirty = None, statuses = None):
 	# Ensure root ends in a slash.
 	while root[-1:] in "\\/": root = root[:-1]
 	if root[-1:] != '/': root += "/"
@@ -231,162 +778,2000 @@ def archive(root, repo, subdirs, filenames, now):
 	while repo and repo[-1] in "\\/": repo = repo[:-1]
 	if repo[-1:] != '/': repo += "/"
 
-	print("Archiving " + root)
-
-	# Warning: Y10K bug on the next line, because it assumes
-	# alphabetically sorted filenames are listed in ascending
-	# timestamp order (due to timestamp prefixing each filename).
-	reposubdirs, repofiles = list_dir_sorted(root + repo)
-
-	# Examine the repository and form a merged list of all files.
-	# The merged list contains all filenames ever stored in the
-	# repository, and for each filename it lists all version dates.
-	mergedfiles = {}
-	for d in repofiles:
-		date = d[0:TIMESTAMP_LENGTH]            # Warning: Y10K bug due to
-		realfilename = d[TIMESTAMP_LENGTH:]     # using a constant slice size.
-		if realfilename not in mergedfiles:
-			mergedfiles[realfilename] = []
-		mergedfiles[realfilename].append(date)
-	
+	sys.stdout.write("Archiving " + root + "\n")
+
+	# The manifest gives the latest version of every name ever
+	# stored in the repository, without examining older versions.
+	manifest = Manifest(root + repo)
+	manifest.load(store)
+
 	# Form directory information as we go into the following.
 	this_dir_text = ''
 	this_dir_hash = ''
 
+	# Cached stat results let unchanged files skip being read.
+	statcache = read_statcache(root + repo + STATCACHE_FILE)
+	new_statcache = {}
+
 	# Process the subdirs, then the filenames, then this dir last.
-	processing_order = subdirs + filenames + [DIR_NAME]
-	for name in processing_order:
+	# Each subdir and file is examined (and stored if need be) by a
+	# worker, then their results are gathered here in the same order,
+	# so this directory's summary doesn't depend on which finished first.
+	if statuses is None:
+		statuses = {}
+	tasks = []
+	for name in subdirs + filenames:
 		# Skip any repository directory, of course.
 		if name == repo[:-1]:
 			continue
+		entry_covered = []
+		tasks.append((name, workers.spawn(archive_entry, root, repo, name, statuses.get(name), now, store, workers, writer, config, manifest, statcache, entry_covered, dirty), entry_covered))
 
-		# Get the base filename of this source path.
-		src = name
-		for sep in '/\\':
-			pos = name.rfind(sep)
-			if pos >= 0:
-				src = src[pos+1:]
+	# A file which changed after it was hashed wasn't stored (see
+	# store_object), so it's archived again once its store has been
+	# tried, and left out if it keeps changing. Nothing is recorded
+	# until then, so no version is listed without its blob.
+	results = []
+	for name, task, entry_covered in tasks:
+		results.append([name, task.result(), entry_covered])
+	writer.flush()
+	for entry in results:
+		name, result, entry_covered = entry
+		attempts = 0
+		while result is not None and result[5] is not None and writer.has_failed(store, result[1]):
+			attempts += 1
+			if attempts >= STORE_ATTEMPTS:
+				sys.stderr.write(THIS_PROGRAM + ": error: " + root + name + " kept changing, so wasn't archived\n")
+				result = None
+				entry_covered = [None]
+				break
+			entry_covered = []
+			result = archive_entry(root, repo, name, None, now, store, workers, writer, config, manifest, statcache, entry_covered, dirty)
+			writer.flush()
+		entry[1:] = [result, entry_covered]
 
-		# Obtain the content of the file or directory.
-		path = root + name
-		try:
-			status = os.stat(path)
-		except:
-			sys.stderr.write(THIS_PROGRAM + ": error: could not stat " + path + "\n")
+	for name, result, entry_covered in results:
+		if covered is not None:
+			covered.extend(entry_covered)
+		if result is None:
 			continue
+		src, digest, mode_str, kind, fingerprint, version = result
 
-		if name == DIR_NAME:
-			# Handle "." specially.
-			content = this_dir_text
-		elif stat.S_ISDIR(status.st_mode):
-			# Recursively handle subdirectories.
-			subdirs2, filenames2 = list_dir_sorted(path)
-			if repo[:-1] not in subdirs2:
-				# Only subdirs which hold repos are recursively visited.
-				# Subdirs lacking a repo are completely ignored.
-				continue
-			content = archive(path, repo, subdirs2, filenames2, now)
-		elif stat.S_ISREG(status.st_mode):
+		# Form summary line from a hash, permissions, and name.
+		this_dir_text += digest + " " + mode_str + " " + src + "\n"
+		if fingerprint is not None:
+			new_statcache[src] = (fingerprint, digest)
+
+		# Record whatever was stored in the repository.
+		if version is not None:
+			date, size = version
+			sys.stdout.write(THIS_PROGRAM + ": storing %s %s\n" % (kind, src))
+			manifest.add(now, date, digest, size, src)
+
+	# Handle "." specially: its summary goes at the top.
+	src = DIR_NAME
+	try:
+		status = statuses.get(DIR_NAME) or os.stat(root + DIR_NAME)
+		mode_str = get_mode_str(status)
+		if covered is not None:
+			covered.append((DIR_NAME, get_fingerprint(status)))
+	except OSError:
+		sys.stderr.write(THIS_PROGRAM + ": error: could not stat " + root + DIR_NAME + "\n")
+		mode_str = None
+		if covered is not None:
+			covered.append(None)
+	if mode_str is not None:
+		summary = hash384base64(this_dir_text) + " " + mode_str + " " + src + "\n"
+		this_dir_text = summary + this_dir_text
+		content = text_bytes(this_dir_text) # Ensure we look for this final form in repo.
+		digest = hash384base64(content)
+
+		# Decide if the content needs to be stored in the repository.
+		latest = manifest.get_latest(src)
+		if latest is None or digest != latest[1]:
+			sys.stdout.write(THIS_PROGRAM + ": storing dir %s\n" % src)
+			writer.store(store, digest, None, content, None, 0, latest)
+			manifest.add(now, now, digest, len(content), src)
+
+	# Record new versions once they're stored, and before caching
+	# that their files are stored.
+	writer.flush()
+	manifest.save()
+	if new_statcache != statcache:
+		write_statcache(root + repo + STATCACHE_FILE, new_statcache)
+
+	return this_dir_text
+
+# Archive one subdir or file named within the directory root,
+# given its stat results (or None to stat it here).
+# Files are stored in the object store (by the writer) if they differ
+# from their latest version in the manifest, but the manifest isn't
+# changed here.
+# The list covered is extended, and dirty used, as for archive().
+# Return None if it's to be skipped, else a tuple of:
+# (name, hash, mode string, kind, stat fingerprint, version)
+# where kind is "dir", "file" or "link", the fingerprint is only given
+# for files, and version is (date, size) of a newly stored file, or None.
+def archive_entry(root, repo, name, status, now, store, workers, writer, config, manifest, statcache, covered, dirty):
+	# Get the base filename of this source path.
+	src = name
+	for sep in '/\\':
+		pos = name.rfind(sep)
+		if pos >= 0:
+			src = src[pos+1:]
+
+	# Obtain the content of the file or directory.
+	path = root + name
+	try:
+		if status is None:
+			status = os.stat(path)
+	except:
+		sys.stderr.write(THIS_PROGRAM + ": error: could not stat " + path + "\n")
+		covered.append(None)
+		return None
+
+	content = None	# Files are streamed rather than held in memory.
+	fingerprint = None
+	unchanged = 0
+	if stat.S_ISDIR(status.st_mode):
+		# A repository reached from above for the first time may
+		# have had its own object store, which is now shared.
+		merge_object_store(path + "/" + repo + OBJECTS_DIR, store)
+
+		# Skip subdirectories in which nothing has changed.
+		treecache_path = path + "/" + repo + TREECACHE_FILE
+		treecache = read_treecache(treecache_path)
+		if treecache and treecache[2] == config.digest and ((dirty is not None and path not in dirty) or is_tree_unchanged(path, treecache[0])):
+			covered.extend(prefix_covered(src, treecache[0]))
+			return (src, hash384base64(treecache[1]), get_mode_str(status), "dir", None, None)
+
+		# Recursively handle subdirectories.
+		statuses2 = {DIR_NAME: status}
+		subdirs2, filenames2 = list_dir_sorted(path, config, statuses2)
+		if repo[:-1] not in subdirs2:
+			# Only subdirs which hold repos are recursively visited.
+			# Subdirs lacking a repo are completely ignored,
+			# unless they gain a repo (which changes their mtime).
+			covered.append((src, get_fingerprint(status)))
+			return None
+		subdir_covered = []
+		text = archive(path, repo, subdirs2, filenames2, now, store, workers, writer, config, subdir_covered, dirty, statuses2)
+		if None in subdir_covered:
+			covered.append(None)
+		else:
+			write_treecache(treecache_path, subdir_covered, text, config.digest)
+			covered.extend(prefix_covered(src, subdir_covered))
+		digest = hash384base64(text)
+		# Note, subdirectories store themselves in their own repository.
+		return (src, digest, get_mode_str(status), "dir", None, None)
+	elif stat.S_ISREG(status.st_mode):
+		fingerprint = get_fingerprint(status)
+		cached = statcache.get(src)
+		unchanged = cached and cached[0] == fingerprint
+		if unchanged:
+			# Unchanged since last archived, so use the cached hash.
+			digest = cached[1]
+		else:
 			# File contents are used to check for changes.
-			if not is_readable_file(path):
+			# Small files are kept in memory, to store without rereading.
+			try:
+				digest, content = read_and_hash(path)
+			except (IOError, OSError):
 				sys.stderr.write(THIS_PROGRAM + ": error: could not read " + path + "\n")
-				continue
-			content = open(path, "rb").read()
-		else:
-			sys.stderr.write(THIS_PROGRAM + ": error: non-file non-dir " + path + "\n")
-			continue # Weird: a non-file non-dir named on command line!
+				covered.append(None)
+				return None
+	else:
+		sys.stderr.write(THIS_PROGRAM + ": error: non-file non-dir " + path + "\n")
+		covered.append(None)
+		return None # Weird: a non-file non-dir named on command line!
+	covered.append((src, fingerprint))
 
-		# Form summary line from a hash, permissions, and name.
-		summary = hash384base64(content) + " " + get_mode_str(path) + " " + src + "\n"
-		if name == DIR_NAME:
-			this_dir_text = summary + this_dir_text # Put "." summary at top.
-			content = this_dir_text # Ensure we look for this final form in repo.
-		else:
-			this_dir_text += summary	# Append summary line at bottom.
+	kind = "file"
+	if stat.S_ISLNK(status.st_mode):
+		kind = "link"
 
-		# Decide if the content needs to be stored in the repository.
+	# Decide if the content needs to be stored in the repository.
+	store_it = 0
+	latest = manifest.get_latest(src)
+	if latest is None:
+		# That name not previously seen in the repo! Store it.
+		store_it = 1
+	elif unchanged:
+		# Unchanged since it was last archived, so already stored.
 		store_it = 0
-		if src not in mergedfiles:
-			# That name not previously seen in the repo! Store it.
-			#if stat.S_ISREG(status.st_mode):
-				#print("Name not previously seen: " + src)
+	else:
+		# Does the latest repo version of the same named file differ?
+		# Stored versions are named by hash, so only hashes are compared.
+		if digest != latest[1]:
+			# Files are different. Store this new file.
 			store_it = 1
-			# Note, subdirectories have already been recursively handled earlier.
 		else:
-			# Does the latest repo version of the same named file differ?
-			dates = mergedfiles[src]
-			latest = dates[-1]
-			repocontent = open(root + repo + latest + src, "rb").read()
-			if content != repocontent:
-				# Files are different. Store this new file.
-				#print("File is different in repo: " + src)
-				store_it = 1
-			else:
-				# Same file as the last version. Do not store it.
-				#print("File is same in repo, skip:" + src)
-				store_it = 0
-			repocontent = "" # Be memory efficient in case of recursion.
-
-		# Store the content, if necessary.
-		if store_it:
-			if name == DIR_NAME:
-				sys.stdout.write(THIS_PROGRAM + ": storing dir %s\n" % name)
-				open(root + repo + now + src, "wb").write(this_dir_text)
-				continue
+			# Same file as the last version. Do not store it.
+			store_it = 0
 
-			utc = time.gmtime(status.st_mtime)
-			date = time.strftime(TIMESTAMP_FORMAT, utc)
-			if stat.S_ISDIR(status.st_mode):
-				#sys.stderr.write(THIS_PROGRAM + ": do not store directory here %s\n" % name)
-				continue
-			elif stat.S_ISLNK(status.st_mode):
-				sys.stdout.write(THIS_PROGRAM + ": storing link %s\n" % name)
-				if USING_LINUX:
-					# Copy underlying data.
-					os.system('/bin/cp -p "' + path + '" "' + root + repo + date + src + '"')
-				else:
-					# Copy the file ourselves (losing permissions and timestamps).
-					open(root + repo + date + src, "wb").write(content)
-			elif stat.S_ISREG(status.st_mode):
-				sys.stdout.write(THIS_PROGRAM + ": storing file %s\n" % name)
-				if USING_LINUX:
-					# Keep permissions data with the file's inode.
-					os.system('/bin/cp -p "' + path + '" "' + root + repo + date + src + '"')
-				else:
-					# Copy the file ourselves (losing permissions and timestamps).
-					open(root + repo + date + src, "wb").write(content)
-		else:
-			# Content already exists in repository.
-			pass
-		content = "" # Be memory efficient in case of recursion.
+	# Store the content, if necessary.
+	version = None
+	if store_it:
+		utc = time.gmtime(status.st_mtime)
+		date = time.strftime(TIMESTAMP_FORMAT, utc)
+		# Copy underlying data (of a link), keeping permissions data.
+		chunked = config.chunk_size and status.st_size > config.chunk_size
+		writer.store(store, digest, path, content, status, chunked, latest)
+		version = (date, status.st_size)
 
-	return this_dir_text
+	return (src, digest, get_mode_str(status), kind, fingerprint, version)
 
 # List subdirectories and filenames in the given path.
 # Only report regular files and subdirectories.
 # Skip device files, links, and the "." and ".." dirs.
+# If a config is given, skip what it says isn't tracked.
+# If statuses is given, it's filled in with each listed name's stat
+# results, so each entry is only stat'ed once, here. Untracked files
+# aren't stat'ed at all, where the listing itself says they're files.
 # Return two lists: subdirnames and filenames.
 # Each list will be alphabetically sorted.
-def list_dir_sorted(dirpath = "."):
+def list_dir_sorted(dirpath = ".", config = None, statuses = None):
 	while dirpath and dirpath[-1] in "\\/":
 		dirpath = dirpath[:-1]
-	names = os.listdir(dirpath)
 	subdirnames = []
 	filenames = []
-	for name in names:
-		if name in [".", ".."]: continue
+	entries = os.scandir(dirpath)
+	for entry in entries:
+		name = entry.name
+		if config and config.is_ignored(name): continue
 		try:
-			status = os.stat(dirpath + os.sep + name)
+			if config and not entry.is_dir() and not config.is_tracked_file(name): continue
+			status = entry.stat()
 		except:
 			continue
 		if stat.S_ISDIR(status.st_mode):   subdirnames.append(name)
 		elif stat.S_ISREG(status.st_mode): filenames.append(name)
+		else: continue
+		if statuses is not None:
+			statuses[name] = status
+	entries.close()
 
 	subdirnames.sort()
 	filenames.sort()
 
 	return (subdirnames, filenames)
 
+# The rules of a config file (see Config file above).
+class Config:
+	def __init__(self, rules, digest, chunk_size = 0):
+		self.rules = rules		# [(keyword, count or None, pattern), ...]
+		self.digest = digest	# Hash of the config file, or "-" if none.
+		self.chunk_size = chunk_size	# Files bigger than this are chunked, unless 0.
+		self.whitelist = 0
+		self.matcher = None
+		for keyword, count, pattern in rules:
+			if keyword == CONFIG_RETAIN:
+				self.whitelist = 1
+		if rules:
+			# One alternative per rule, tried in order.
+			alternatives = []
+			for i in range(len(rules)):
+				alternatives.append("(?P<r%d>%s)" % (i, fnmatch.translate(rules[i][2])))
+			self.matcher = re.compile("|".join(alternatives))
+
+	# Return the (keyword, count, pattern) of the first rule matching name, or None.
+	def find_rule(self, name):
+		if self.matcher is None:
+			return None
+		match = self.matcher.match(name)
+		if match is None:
+			return None
+		return self.rules[int(match.lastgroup[1:])]
+
+	def is_ignored(self, name):
+		rule = self.find_rule(name)
+		return rule is not None and rule[0] == CONFIG_IGNORE
+
+	def is_tracked_file(self, name):
+		rule = self.find_rule(name)
+		if rule is None:
+			return not self.whitelist
+		return rule[0] == CONFIG_RETAIN
+
+	# Return how many versions of name to keep, or None for all of them.
+	def get_retain(self, name):
+		rule = self.find_rule(name)
+		if rule is None or rule[0] != CONFIG_RETAIN:
+			return None
+		return rule[1]
+
+# Read the config file at path. Return a Config, or None if it has errors.
+def read_config(path):
+	try:
+		content = open(path, "rb").read()
+	except (IOError, OSError):
+		return Config([], "-")
+	rules = []
+	chunk_size = 0
+	errors = 0
+	line_num = 0
+	for line in content.decode("utf-8", "surrogateescape").split("\n"):
+		line_num += 1
+		line = line.strip()
+		if not line or line[:1] == "#":
+			continue
+		keyword, sep, value = line.partition(":")
+		keyword = keyword.strip()
+		value = value.strip()
+		if sep and keyword == CONFIG_CHUNK and value.isdigit() and int(value) > 0:
+			chunk_size = int(value)
+			continue
+		count = None
+		parts = value.split(None, 1)
+		if keyword == CONFIG_RETAIN and len(parts) == 2 and parts[0].isdigit():
+			count = int(parts[0])
+			value = parts[1]
+		if not sep or keyword not in (CONFIG_RETAIN, CONFIG_IGNORE) or not value or count == 0:
+			sys.stderr.write(THIS_PROGRAM + ": error: %s line %d not understood: %s\n" % (path, line_num, line))
+			errors += 1
+			continue
+		rules.append((keyword, count, value))
+	if errors:
+		return None
+	return Config(rules, hash384base64(content), chunk_size)
+
+# Shorten the manifests sharing the object store to the Retain limits
+# of the config, then delete every blob, loose or packed, which is no
+# longer listed in any manifest nor needed to rebuild one that is.
+def gc(repo, store, config):
+	live = set()
+	dropped = 0
+	for repopath in find_repositories(store, repo):
+		manifest = Manifest(repopath)
+		manifest.load(store)
+		manifest.save()		# In case the manifest was just imported.
+		dropped += manifest.retain(config)
+		for name in manifest.history:
+			for version in manifest.history[name][1]:
+				live.add(version[2])
+
+	# Blobs kept as deltas need the blobs they're based on,
+	# and blobs kept as chunks need their chunks.
+	pending = list(live)
+	while pending:
+		digest = pending.pop()
+		if os.path.exists(object_path(store, digest)):
+			continue
+		try:
+			kind, content = read_stored_object(store, digest)
+		except (IOError, OSError):
+			continue	# Missing already (verify would say so).
+		for ref in get_object_refs(kind, content):
+			if ref not in live:
+				live.add(ref)
+				pending.append(ref)
+
+	# Delete dead loose objects.
+	deleted = 0
+	for subdir in sorted(os.listdir(store)):
+		if len(subdir) != 2 or not os.path.isdir(store + subdir):
+			continue	# E.g. the packs directory.
+		for name in os.listdir(store + subdir):
+			parsed = parse_loose_name(subdir, name)
+			if parsed is None:
+				continue	# Being written.
+			digest, kind = parsed
+			if digest not in live:
+				os.remove(store + subdir + "/" + name)
+				deleted += 1
+
+	# Rewrite packs holding dead objects, copying their live
+	# objects as they are, without decompressing them.
+	for pack in get_packs(store):
+		records = list(pack.records())
+		keep = [record for record in records if record[0] in live]
+		if len(keep) == len(records):
+			continue
+		deleted += len(records) - len(keep)
+		if keep:
+			base = pack.pack_path[:-len(".pack")] + "g"
+			out = open(temp_path(base + ".pack"), "wb")
+			out.write(PACK_HEADER)
+			offset = len(PACK_HEADER)
+			index = []
+			for digest, old_offset, length, kind, compression in keep:
+				out.write(read_at(pack.fd, old_offset, length))
+				index.append(struct.pack(PACK_IDX_RECORD, base64.urlsafe_b64decode(digest), offset, length, kind, compression))
+				offset += length
+			out.flush()
+			os.fsync(out.fileno())
+			out.close()
+			idx = open(temp_path(base + ".idx"), "wb")
+			idx.write(PACK_IDX_HEADER + struct.pack(">Q", len(index)) + b"".join(index))
+			idx.flush()
+			os.fsync(idx.fileno())
+			idx.close()
+			os.rename(temp_path(base + ".pack"), base + ".pack")
+			os.rename(temp_path(base + ".idx"), base + ".idx")
+		os.remove(pack.idx_path)
+		os.remove(pack.pack_path)
+
+	sys.stdout.write(THIS_PROGRAM + ": dropped %d versions, deleted %d objects\n" % (dropped, deleted))
+
+# Find the object store shared by this repository and its relatives.
+# It lives in the outermost repository reached by walking up through
+# parent directories for as long as each one holds a repository.
+# Any repositories on the way which had stores of their own, from
+# before there was a repository above them, are merged into it.
+# Return the store's path, ending in a slash.
+def find_object_store(repo, dirpath = "."):
+	dirpath = os.path.abspath(dirpath)
+	start = dirpath
+	while True:
+		parent = os.path.dirname(dirpath)
+		if parent == dirpath or not repo_exists(repo, parent):
+			break
+		dirpath = parent
+	while repo and repo[-1] in "\\/":
+		repo = repo[:-1]
+	store = os.path.join(dirpath, repo, OBJECTS_DIR)
+	while start != dirpath:
+		merge_object_store(os.path.join(start, repo, OBJECTS_DIR), store)
+		start = os.path.dirname(start)
+	return store
+
+# Move the objects in a nested repository's own object store (made while
+# there was no repository above it) into the store it now shares, then
+# remove it, so the versions listed in its manifest can still be found.
+# Loose objects the shared store already has (in full, or at all for
+# deltas and lists of chunks) are dropped, and packfiles moved whole.
+def merge_object_store(old_store, store):
+	if not os.path.isdir(old_store) or os.path.abspath(old_store) == os.path.abspath(store):
+		return
+	sys.stdout.write(THIS_PROGRAM + ": merging " + old_store + " into " + store + "\n")
+	for subdir in sorted(os.listdir(old_store)):
+		dirpath = old_store + subdir + "/"
+		if subdir + "/" == PACKS_DIR:
+			packdir = store + PACKS_DIR
+			if not os.path.isdir(packdir):
+				os.makedirs(packdir)
+			# Each index is moved after its packfile, as it makes it usable.
+			names = os.listdir(dirpath)
+			names.sort(key = lambda name: (name[-len(".idx"):] == ".idx", name))
+			for name in names:
+				if ".tmp" in name or os.path.exists(packdir + name):
+					os.remove(dirpath + name)
+				else:
+					shutil.move(dirpath + name, packdir + name)
+		elif len(subdir) == 2 and os.path.isdir(dirpath):
+			for name in os.listdir(dirpath):
+				path = dirpath + name
+				parsed = parse_loose_name(subdir, name)
+				if parsed is None:
+					os.remove(path)		# Left over from a crash.
+					continue
+				digest, kind = parsed
+				dest = object_path(store, digest)
+				if kind == b"F":
+					if os.path.exists(dest):
+						os.remove(path)
+						continue
+				elif object_exists(store, digest):
+					os.remove(path)
+					continue
+				else:
+					dest += name[len(digest)-2:]	# Keep its suffix.
+				if not os.path.isdir(os.path.dirname(dest)):
+					try:
+						os.makedirs(os.path.dirname(dest))
+					except OSError:
+						pass	# Already made by somebody else.
+				shutil.move(path, dest)
+				if kind == b"F" and os.path.exists(dest + DELTA_SUFFIX):
+					os.remove(dest + DELTA_SUFFIX)	# The full copy is enough.
+		else:
+			continue
+		os.rmdir(dirpath)
+	if os.path.exists(old_store + LATEST_COUNTS_FILE):
+		os.remove(old_store + LATEST_COUNTS_FILE)
+	forget_latest_counts(store)	# Its repositories now share store.
+	try:
+		os.rmdir(old_store)
+	except OSError:
+		sys.stderr.write(THIS_PROGRAM + ": error: could not remove " + old_store + "\n")
+
+# Path of the blob with the given hash within the object store.
+def object_path(store, digest):
+	return store + digest[:2] + "/" + digest[2:]
+
+# Copy content into the object store, unless it's already there.
+# Content comes from the file at path, else from the given bytes.
+# If both are given, the bytes are the file's already read content.
+# A file copied without its content is hashed again as copied, since it
+# may have changed after it was hashed; if so, nothing is stored.
+# Return 1 if a new blob was written, 0 if it already existed,
+# or -1 if the file no longer has the given hash.
+def store_object(store, digest, path = None, content = None, status = None, commits = None):
+	dest = object_path(store, digest)
+	if os.path.exists(dest):
+		return 0
+	# If it's only stored as a delta, it's stored in full again. It's
+	# about to be the latest version, so should be quick to reach, and
+	# it can then be used as the base for a delta of a previous version.
+	dirpath = os.path.dirname(dest)
+	if not os.path.isdir(dirpath):
+		try:
+			os.makedirs(dirpath)
+		except OSError:
+			pass	# Already made by somebody else.
+
+	# Write to a temporary name then rename, so that a blob
+	# present under its final name is always complete.
+	temp = temp_path(dest)
+	if path is not None:
+		# Keep permissions data with the file's inode.
+		copy_file(path, temp, content, status)
+		if content is None and hash_file(temp) != digest:
+			os.remove(temp)
+			sys.stderr.write(THIS_PROGRAM + ": error: " + path + " changed while being archived\n")
+			return -1
+	else:
+		open(temp, "wb").write(content)
+	if commits is None:
+		commit_files([(temp, dest, dest + DELTA_SUFFIX)])
+	else:
+		commits.append((temp, dest, dest + DELTA_SUFFIX))
+	return 1
+
+# Make files written under temporary names durable, give them their
+# final names, then remove the files they replace, as described in
+# Object store above. commits is a list of (temporary path, final
+# path, path to remove if it exists). A temporary path listed more
+# than once was rewritten with the same content, so is renamed once.
+def commit_files(commits):
+	renames = {}
+	for temp, dest, old in commits:
+		if temp not in renames:
+			fd = os.open(temp, os.O_RDONLY)
+			try:
+				os.fsync(fd)
+			finally:
+				os.close(fd)
+		renames[temp] = (dest, old)
+	dirpaths = set()
+	for temp in renames:
+		dest, old = renames[temp]
+		os.rename(temp, dest)
+		dirpaths.add(os.path.dirname(dest))
+	# Directories can't be opened to fsync them on Windows.
+	if USING_LINUX:
+		for dirpath in dirpaths:
+			fd = os.open(dirpath, os.O_RDONLY)
+			try:
+				os.fsync(fd)
+			finally:
+				os.close(fd)
+	for temp in renames:
+		dest, old = renames[temp]
+		if old is not None and os.path.exists(old):
+			os.remove(old)
+
+# Store the file at path, whose hash is digest, as content-defined
+# chunks (see Chunked storage above), unless it's already stored so.
+# If commits is given, the files written are added to it rather than
+# committed here, as for store_object(). The file is hashed again as
+# it's read, and if it no longer has the hash digest, no list is stored.
+# Return 1 if a new list of chunks was written, 0 if it was already
+# stored, or -1 if the file no longer has the given hash.
+def store_chunked(store, digest, path, commits = None):
+	dest = object_path(store, digest)
+	if os.path.exists(dest) or os.path.exists(dest + CHUNKS_SUFFIX):
+		return 0
+	written = commits
+	if written is None:
+		written = []
+	lines = [CHUNKS_HEADER]
+	h = hashlib.sha384()
+	f = open(path, "rb")
+	data = b""
+	while True:
+		more = f.read(CHUNK_SIZE)
+		h.update(more)
+		data += more
+		while len(data) >= CDC_MAX_CHUNK or (data and not more):
+			cut = find_chunk_end(data)
+			chunk = data[:cut]
+			data = data[cut:]
+			chunk_digest = hash384base64(chunk)
+			store_object(store, chunk_digest, content=chunk, commits=written)
+			lines.append(b"%s %d\n" % (chunk_digest.encode("ascii"), len(chunk)))
+		if not more:
+			break
+	f.close()
+	if base64.urlsafe_b64encode(h.digest()).decode("ascii") != digest:
+		sys.stderr.write(THIS_PROGRAM + ": error: " + path + " changed while being archived\n")
+		if commits is None:
+			commit_files(written)	# Its chunks are still valid blobs.
+		return -1
+	dirpath = os.path.dirname(dest)
+	if not os.path.isdir(dirpath):
+		try:
+			os.makedirs(dirpath)
+		except OSError:
+			pass	# Already made by somebody else.
+	temp = temp_path(dest + CHUNKS_SUFFIX)
+	open(temp, "wb").write(b"".join(lines))
+	written.append((temp, dest + CHUNKS_SUFFIX, dest + DELTA_SUFFIX))
+	if commits is None:
+		commit_files(written)
+	return 1
+
+# Return the length of the first chunk of data, which is where a
+# rolling "gear" hash of the bytes before it has its top CDC_BITS
+# bits all zero, subject to CDC_MIN_CHUNK and CDC_MAX_CHUNK.
+# The hash shifts each byte out after 32 more, so needn't start
+# from the beginning of the chunk: the hash after each byte is the sum
+# of the gear values of it and the 31 before, shifted left by 0 to 31.
+# Rather than a Python loop per byte, a block at a time is hashed at
+# once using big integers: the gear values (found with translate) are
+# spaced CDC_SLOT bytes apart, so each sum fits without carrying into
+# the next, then shifted copies are added, doubling the bytes summed
+# each time. The masked bytes of the hashes are OR'ed together the
+# same way, so the first zero byte is the end of the chunk.
+def find_chunk_end(data):
+	end = min(len(data), CDC_MAX_CHUNK)
+	if end <= CDC_MIN_CHUNK:
+		return end
+	pos = CDC_MIN_CHUNK
+	while pos < end:
+		stop = min(pos + CDC_BLOCK, end)
+		block = data[pos-31:stop]
+		n = len(block)
+		gears = bytearray(CDC_SLOT * n)
+		for j in range(4):
+			gears[j::CDC_SLOT] = block.translate(CDC_GEAR_BYTES[j])
+		h = int.from_bytes(gears, "little")
+		shift = 8 * CDC_SLOT + 1
+		for i in range(5):
+			h += h << shift
+			shift *= 2
+		hashes = h.to_bytes(CDC_SLOT * (n + 40), "little")
+		masked = 0
+		for j in range(4):
+			masked |= int.from_bytes(hashes[j:CDC_SLOT*n:CDC_SLOT].translate(CDC_MASK_BYTES[j]), "little")
+		i = masked.to_bytes(n, "little").find(0, 31)
+		if i >= 0:
+			return pos - 31 + i + 1
+		pos = stop
+	return end
+
+# Return the hashes of the blobs needed to rebuild a stored object
+# of the given kind (see read_stored_object): its base if it's a
+# delta, or its chunks if it's a list of chunks.
+def get_object_refs(kind, content):
+	refs = []
+	if kind == b"D":
+		pos = content.find(b"\n")
+		if content[:len(DELTA_HEADER)] == DELTA_HEADER and pos > 0:
+			refs.append(content[len(DELTA_HEADER):pos].decode("ascii"))
+	elif kind == b"C":
+		for line in content[len(CHUNKS_HEADER):].split(b"\n"):
+			if line:
+				refs.append(line.split(b" ")[0].decode("ascii"))
+	return refs
+
+# Return the (hash, kind) of an object stored loose as subdir/name
+# in the object store (see read_stored_object), or None if it's
+# a temporary file being written.
+def parse_loose_name(subdir, name):
+	if ".tmp" in name:
+		return None
+	for kind, suffix in ((b"D", DELTA_SUFFIX), (b"C", CHUNKS_SUFFIX)):
+		if name[-len(suffix):] == suffix:
+			return subdir + name[:-len(suffix)], kind
+	return subdir + name, b"F"
+
+# Return 1 if the blob with the given hash is stored, in full, as
+# a delta or as chunks, loose or packed.
+def object_exists(store, digest):
+	dest = object_path(store, digest)
+	if os.path.exists(dest) or os.path.exists(dest + DELTA_SUFFIX) or os.path.exists(dest + CHUNKS_SUFFIX):
+		return 1
+	for pack in get_packs(store):
+		if pack.find(digest) is not None:
+			return 1
+	return 0
+
+# A packfile and its index (see Packfiles above).
+class Pack:
+	def __init__(self, idx_path):
+		self.idx_path = idx_path
+		self.pack_path = idx_path[:-len(".idx")] + ".pack"
+		f = open(idx_path, "rb")
+		self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		f.close()
+		if self.idx[:len(PACK_IDX_HEADER)] != PACK_IDX_HEADER:
+			raise IOError("damaged pack index " + idx_path)
+		self.start = len(PACK_IDX_HEADER) + 8
+		self.count, = struct.unpack(">Q", self.idx[self.start-8:self.start])
+		self.record_size = struct.calcsize(PACK_IDX_RECORD)
+		self.fd = os.open(self.pack_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+	# Return the (offset, length, kind, compression) of an object, or None.
+	def find(self, digest):
+		key = base64.urlsafe_b64decode(digest)
+		lo = 0
+		hi = self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			pos = self.start + mid * self.record_size
+			found = self.idx[pos:pos+48]
+			if found < key:
+				lo = mid + 1
+			elif found > key:
+				hi = mid
+			else:
+				return struct.unpack(PACK_IDX_RECORD, self.idx[pos:pos+self.record_size])[1:]
+		return None
+
+	# Return the (kind, data) of an object, as for read_stored_object,
+	# or None if it's not in this pack.
+	def read(self, digest):
+		found = self.find(digest)
+		if found is None:
+			return None
+		offset, length, kind, compression = found
+		return kind, decompress(compression, read_at(self.fd, offset, length))
+
+	# Yield the (hash, offset, length, kind, compression) of each object.
+	def records(self):
+		for i in range(self.count):
+			pos = self.start + i * self.record_size
+			record = struct.unpack(PACK_IDX_RECORD, self.idx[pos:pos+self.record_size])
+			yield (base64.urlsafe_b64encode(record[0]).decode("ascii"),) + record[1:]
+
+Packs_Lock = threading.Lock()
+Packs_Cache = {}	# Store -> (packs directory's mtime, [Pack, ...])
+
+# Return the packs in the object store, most recent first.
+def get_packs(store):
+	packdir = store + PACKS_DIR
+	try:
+		mtime = os.stat(packdir).st_mtime_ns
+	except OSError:
+		return []
+	with Packs_Lock:
+		cached = Packs_Cache.get(store)
+		if cached and cached[0] == mtime:
+			return cached[1]
+		packs = []
+		for name in sorted(os.listdir(packdir), reverse=True):
+			if name[-len(".idx"):] == ".idx":
+				try:
+					packs.append(Pack(packdir + name))
+				except (IOError, OSError, ValueError):
+					sys.stderr.write(THIS_PROGRAM + ": error: could not read pack " + packdir + name + "\n")
+		Packs_Cache[store] = (mtime, packs)
+		return packs
+
+def read_at(fd, offset, length):
+	if hasattr(os, "pread"):
+		return os.pread(fd, length, offset)
+	with Packs_Lock:
+		os.lseek(fd, offset, os.SEEK_SET)
+		return os.read(fd, length)
+
+def compress(compression, data):
+	if compression == b"x":
+		return lzma.compress(data)
+	return zlib.compress(data)
+
+def decompress(compression, data):
+	if compression == b"x":
+		return lzma.decompress(data)
+	return zlib.decompress(data)
+
+# Return a dictionary from each hash which is the latest version of
+# any name, in any repository sharing the object store, to how many
+# names it's the latest version of. Every manifest is read.
+def count_latest_digests(store, repo):
+	counts = {}
+	for repopath in find_repositories(store, repo):
+		manifest = Manifest(repopath)
+		manifest.load(store)
+		for name in manifest.latest:
+			digest = manifest.latest[name][1]
+			counts[digest] = counts.get(digest, 0) + 1
+	return counts
+
+# Read the counts of latest versions kept in the object store
+# (see Reverse deltas above). Return None if they're missing or damaged.
+def read_latest_counts(store):
+	counts = {}
+	try:
+		for line in open(store + LATEST_COUNTS_FILE, "rb"):
+			digest, count = line.decode("ascii").split(" ")
+			counts[digest] = int(count)
+	except (IOError, OSError, ValueError):
+		return None
+	return counts
+
+def write_latest_counts(store, counts):
+	path = store + LATEST_COUNTS_FILE
+	temp = temp_path(path)
+	try:
+		f = open(temp, "wb")
+		f.write(b"".join(b"%s %d\n" % (digest.encode("ascii"), counts[digest]) for digest in sorted(counts)))
+		f.flush()
+		os.fsync(f.fileno())
+		f.close()
+		os.replace(temp, path)
+	except (IOError, OSError):
+		sys.stderr.write(THIS_PROGRAM + ": error: could not write " + path + "\n")
+
+# Stores whose latest counts must be rebuilt before they're next written.
+Stale_Latest_Counts = set()
+
+# Have the store's latest counts rebuilt, by the next archiving run
+# if not this one, as something other than archiving changed them.
+def forget_latest_counts(store):
+	if os.path.exists(store + LATEST_COUNTS_FILE):
+		os.remove(store + LATEST_COUNTS_FILE)
+	Stale_Latest_Counts.add(store)
+
+# Move loose objects which aren't the latest version of any name, in
+# any repository sharing the object store, into a new packfile.
+def repack(repo, store, compression):
+	latest = set(count_latest_digests(store, repo))
+
+	# The chunks of the latest versions are left loose too.
+	for digest in list(latest):
+		try:
+			content = open(object_path(store, digest) + CHUNKS_SUFFIX, "rb").read()
+		except (IOError, OSError):
+			continue
+		latest.update(get_object_refs(b"C", content))
+
+	# Gather the loose objects to pack, sorted by hash for the index.
+	loose = []
+	for subdir in sorted(os.listdir(store)):
+		if len(subdir) != 2 or not os.path.isdir(store + subdir):
+			continue	# E.g. the packs directory.
+		for name in os.listdir(store + subdir):
+			parsed = parse_loose_name(subdir, name)
+			if parsed is None:
+				continue	# Being written.
+			digest, kind = parsed
+			if digest in latest:
+				continue
+			path = store + subdir + "/" + name
+			if os.path.getsize(path) > PACK_MAX_SIZE:
+				continue
+			loose.append((base64.urlsafe_b64decode(digest), kind, path))
+	loose.sort()
+	if not loose:
+		sys.stdout.write(THIS_PROGRAM + ": nothing to repack\n")
+		return
+
+	# Write the packfile then its index, each in full before it's
+	# given its final name, and the index last as it makes it usable.
+	packdir = store + PACKS_DIR
+	if not os.path.isdir(packdir):
+		os.makedirs(packdir)
+	base = packdir + "pack-" + time.strftime(TIMESTAMP_FORMAT, time.gmtime()) + "%d" % os.getpid()
+	pack = open(temp_path(base + ".pack"), "wb")
+	pack.write(PACK_HEADER)
+	offset = len(PACK_HEADER)
+	records = []
+	for key, kind, path in loose:
+		data = compress(compression, open(path, "rb").read())
+		pack.write(data)
+		records.append(struct.pack(PACK_IDX_RECORD, key, offset, len(data), kind, compression))
+		offset += len(data)
+	pack.flush()
+	os.fsync(pack.fileno())
+	pack.close()
+	idx = open(temp_path(base + ".idx"), "wb")
+	idx.write(PACK_IDX_HEADER + struct.pack(">Q", len(records)) + b"".join(records))
+	idx.flush()
+	os.fsync(idx.fileno())
+	idx.close()
+	os.rename(temp_path(base + ".pack"), base + ".pack")
+	os.rename(temp_path(base + ".idx"), base + ".idx")
+
+	for key, kind, path in loose:
+		os.remove(path)
+	sys.stdout.write(THIS_PROGRAM + ": packed %d objects into %s\n" % (len(loose), base + ".pack"))
+
+# Check out the revision rev of the directory root.
+# Return the number of files which could not be checked out.
+def checkout_dir(root, repo, rev, store, workers, force):
+	while root[-1:] in "\\/": root = root[:-1]
+	while repo and repo[-1] in "\\/": repo = repo[:-1]
+	manifest = Manifest(root + "/" + repo + "/")
+	manifest.load(store)
+	version = find_version(manifest, DIR_NAME, rev)
+	if version is None:
+		sys.stderr.write(THIS_PROGRAM + ": error: no revision " + rev + " of " + root + "\n")
+		return 1
+	sys.stdout.write(THIS_PROGRAM + ": checking out %s of %s\n" % (version[1], root))
+	return checkout_tree(root, repo, version[2], store, workers, force)
+
+# Check out the directory summary with the given hash into root,
+# then recursively check out the subdirectories it lists.
+def checkout_tree(root, repo, digest, store, workers, force):
+	try:
+		entries = parse_dir_text(read_object(store, digest))
+	except (IOError, OSError, ValueError):
+		sys.stderr.write(THIS_PROGRAM + ": error: could not read revision " + digest + " of " + root + "\n")
+		return 1
+
+	# The latest versions tell which files are safe to overwrite.
+	manifest = Manifest(root + "/" + repo + "/")
+	manifest.load(store)
+	statcache = read_statcache(root + "/" + repo + "/" + STATCACHE_FILE)
+
+	tasks = []
+	for digest, mode_str, name in entries[1:]:
+		path = root + "/" + name
+		if mode_str[:1] == "d":
+			if not os.path.isdir(path + "/" + repo):
+				os.makedirs(path + "/" + repo)
+			tasks.append(workers.spawn(checkout_tree, path, repo, digest, store, workers, force))
+		else:
+			tasks.append(workers.spawn(checkout_path, path, manifest, name, statcache.get(name), digest, mode_str, store, force))
+	failures = 0
+	for task in tasks:
+		failures += task.result()
+	return failures
+
+# Check out a revision of one file, named relative to here.
+# Return 1 if that failed, else 0.
+def checkout_file(name, repo, rev, store, force):
+	dirpath, src = os.path.split(name)
+	while repo and repo[-1] in "\\/": repo = repo[:-1]
+	repopath = os.path.join(dirpath, repo) + "/"
+	if not os.path.isdir(repopath):
+		sys.stderr.write(THIS_PROGRAM + ": error: no repository for " + name + "\n")
+		return 1
+	manifest = Manifest(repopath)
+	manifest.load(store)
+
+	# The revision may be of the file itself, or of this directory,
+	# in which case the file is found by descending through the
+	# revisions of each subdirectory above it.
+	version = find_version(manifest, src, rev)
+	mode_str = None
+	if version is None and not is_timestamp(rev):
+		top = Manifest(repo + "/")
+		top.load(store)
+		dir_version = find_version(top, DIR_NAME, rev)
+		if dir_version is not None:
+			digest = dir_version[2]
+			for part in os.path.normpath(name).split(os.sep):
+				found = None
+				try:
+					entries = parse_dir_text(read_object(store, digest))
+				except (IOError, OSError, ValueError):
+					sys.stderr.write(THIS_PROGRAM + ": error: could not read revision " + digest + " of " + name + "\n")
+					return 1
+				for entry in entries[1:]:
+					if entry[2] == part:
+						found = entry
+				if found is None:
+					break
+				digest, mode_str = found[:2]
+			if found is not None and mode_str[:1] != "d":
+				version = (dir_version[0], dir_version[1], digest, None)
+	if version is None:
+		sys.stderr.write(THIS_PROGRAM + ": error: no revision " + rev + " of " + name + "\n")
+		return 1
+	statcache = read_statcache(repopath + STATCACHE_FILE)
+	return checkout_path(name, manifest, src, statcache.get(src), version[2], mode_str, store, force)
+
+# Write the blob with the given hash to path, with the permissions in
+# mode_str (if given). Unless forced, an existing file is only replaced
+# if it's a version archived under its name in the manifest, so nothing
+# is lost. Return 1 if that failed, else 0.
+def checkout_path(path, manifest, name, cached, digest, mode_str, store, force):
+	try:
+		status = os.stat(path)
+	except OSError:
+		status = None
+	if status is not None and not force:
+		if cached and cached[0] == get_fingerprint(status):
+			current = cached[1]
+		else:
+			current = hash_file(path)
+		if current == digest:
+			return 0	# Already checked out.
+		if not manifest.has_version(name, current):
+			sys.stderr.write(THIS_PROGRAM + ": error: not overwriting unarchived changes in " + path + "\n")
+			return 1
+
+	# Loose full blobs are copied, keeping their timestamps,
+	# and possibly sharing their data blocks (see copy_fd).
+	temp = temp_path(path)
+	try:
+		blob = object_path(store, digest)
+		if os.path.exists(blob):
+			copy_file(blob, temp)
+		else:
+			f = open(temp, "wb")
+			for piece in iter_object(store, digest):
+				f.write(piece)
+			f.close()
+		if mode_str is not None:
+			os.chmod(temp, parse_mode_str(mode_str))
+		elif status is not None:
+			os.chmod(temp, stat.S_IMODE(status.st_mode))
+		os.replace(temp, path)
+	except (IOError, OSError) as e:
+		sys.stderr.write(THIS_PROGRAM + ": error: could not check out " + path + ": " + str(e) + "\n")
+		if os.path.exists(temp):
+			os.remove(temp)
+		return 1
+	sys.stdout.write(THIS_PROGRAM + ": checked out %s\n" % path)
+	return 0
+
+# Return the (run, version, hash, size) of the name's version
+# identified by rev (see checkout above), or None if there's none.
+def find_version(manifest, name, rev):
+	if is_timestamp(rev):
+		# Pad a partial timestamp to the end of the period it names.
+		return manifest.get_version_as_of(name, rev + "~")
+	found = None
+	for version in manifest.get_versions(name):
+		if version[2][:len(rev)] == rev:
+			if found is not None and found[2] != version[2]:
+				sys.stderr.write(THIS_PROGRAM + ": error: ambiguous revision " + rev + "\n")
+				return None
+			found = version
+	return found
+
+# List the versions of name (see Logging above) archived from since
+# until until (timestamps, either of which may be None), or of every
+# name in this directory's repository if name is None.
+# Return 1 if there's no such file or directory, else 0.
+def log(name, repo, since, until, store):
+	while repo and repo[-1] in "\\/": repo = repo[:-1]
+	dirpath = "."
+	src = None
+	if name is not None:
+		if os.path.isdir(os.path.join(name, repo)):
+			dirpath, src = name, DIR_NAME
+		else:
+			dirpath, src = os.path.split(name)
+	repopath = os.path.join(dirpath, repo) + "/"
+	if not os.path.isdir(repopath):
+		sys.stderr.write(THIS_PROGRAM + ": error: no repository for " + name + "\n")
+		return 1
+	manifest = Manifest(repopath)
+	manifest.load(store)
+	if src is not None and manifest.get_latest(src) is None:
+		sys.stderr.write(THIS_PROGRAM + ": error: no versions of " + name + "\n")
+		return 1
+
+	if until is not None:
+		until += "~"	# The end of the period it names.
+	if src is not None:
+		versions = []
+		for entry in manifest.iter_versions(src):
+			if since is not None and entry[0] < since:
+				break
+			if until is None or entry[0] <= until:
+				versions.append(entry)
+	else:
+		versions = list(manifest.iter_runs(since, until))
+		versions.reverse()
+	for run, version, digest, size, src in versions:
+		path = os.path.normpath(os.path.join(dirpath, src))
+		sys.stdout.write("%s %s %10d %s %s\n" % (run, version, size, digest, path))
+	return 0
+
+def is_timestamp(rev):
+	return len(rev) >= 5 and rev[:1] == "Y" and rev[1:5].isdigit()
+
+# Return a list of (hash, mode string, name) from a directory summary.
+def parse_dir_text(content):
+	entries = []
+	for line in content.decode("utf-8", "surrogateescape").split("\n"):
+		if line:
+			digest, mode_str, name = line.split(" ", 2)
+			entries.append((digest, mode_str, name))
+	return entries
+
+# Return the permission bits described by a string like "-rwxr-xr-x".
+def parse_mode_str(mode_str):
+	mode = 0
+	bits = [stat.S_IRUSR, stat.S_IWUSR, stat.S_IXUSR,
+		stat.S_IRGRP, stat.S_IWGRP, stat.S_IXGRP,
+		stat.S_IROTH, stat.S_IWOTH, stat.S_IXOTH]
+	for ch, bit in zip(mode_str[1:], bits):
+		if ch != "-":
+			mode |= bit
+	return mode
+
+# Check the versions in every repository sharing the object store,
+# using a pool of processes. With fast set, only check those added
+# to each manifest since it was last verified without problems.
+# Return the number of problems found.
+def verify(repo, store, jobs, fast):
+	# Gather the versions to check, each distinct blob once.
+	users = {}		# Hash -> [(repository path, name, version), ...]
+	checks = []		# [(store, hash, size, is directory summary), ...]
+	verified = []	# [(repository path, manifest length), ...]
+	for repopath in find_repositories(store, repo):
+		manifest = Manifest(repopath)
+		manifest.load(store)
+		manifest.save()		# In case the manifest was just imported.
+		offset = 0
+		if fast:
+			try:
+				offset = int(open(repopath + VERIFIED_FILE).read())
+			except (IOError, OSError, ValueError):
+				pass
+		try:
+			f = open(manifest.path, "rb")
+		except (IOError, OSError):
+			continue
+		f.seek(offset)
+		for line in f:
+			entry = parse_manifest_line(line)
+			if entry is None:
+				break
+			offset += len(line)
+			run, version, digest, size, prev, name = entry
+			if digest not in users:
+				users[digest] = []
+				checks.append((store, digest, size, name == DIR_NAME))
+			users[digest].append((repopath, name, version))
+		f.close()
+		verified.append((repopath, offset))
+
+	sys.stdout.write(THIS_PROGRAM + ": verifying %d blobs with %d processes\n" % (len(checks), jobs))
+	problems = []
+	if jobs > 1 and len(checks) > 1:
+		pool = concurrent.futures.ProcessPoolExecutor(jobs)
+		results = pool.map(verify_object, checks, chunksize=max(1, min(64, len(checks) // (jobs * 4))))
+	else:
+		pool = None
+		results = map(verify_object, checks)
+	for check, problem in zip(checks, results):
+		if problem:
+			for repopath, name, version in users[check[1]]:
+				problems.append("%s %s%s %s %s" % (problem, repopath, name, version, check[1]))
+	if pool:
+		pool.shutdown()
+
+	for problem in sorted(problems):
+		sys.stdout.write(THIS_PROGRAM + ": " + problem + "\n")
+	if not problems:
+		for repopath, offset in verified:
+			temp = temp_path(repopath + VERIFIED_FILE)
+			open(temp, "w").write("%d\n" % offset)
+			os.replace(temp, repopath + VERIFIED_FILE)
+	sys.stdout.write(THIS_PROGRAM + ": %d problems found\n" % len(problems))
+	return len(problems)
+
+# Check one blob given (store, hash, size, is directory summary).
+# Return None if it's fine, else "missing" or "corrupt".
+def verify_object(check):
+	store, digest, size, is_dir = check
+	try:
+		if not is_dir:
+			# Files are streamed, so may be any size.
+			h = hashlib.sha384()
+			length = 0
+			for piece in iter_object(store, digest):
+				h.update(piece)
+				length += len(piece)
+			if length != size or base64.urlsafe_b64encode(h.digest()).decode("ascii") != digest:
+				return "corrupt"
+			return None
+		content = read_object(store, digest)
+	except (IOError, OSError):
+		if object_exists(store, digest):
+			return "corrupt"
+		return "missing"
+	except (ValueError, struct.error, zlib.error, lzma.LZMAError):
+		return "corrupt"
+	if len(content) != size or hash384base64(content) != digest:
+		return "corrupt"
+	if is_dir:
+		# The first line, for ".", gives the hash of the other lines.
+		pos = content.find(b"\n")
+		if pos < 0 or content[:pos].split(b" ")[0].decode("ascii", "replace") != hash384base64(content[pos+1:]):
+			return "corrupt"
+	return None
+
+# Return the repository paths which share the object store, i.e. the
+# outermost repository and those in subdirectories reached through
+# directories which all hold repositories.
+def find_repositories(store, repo):
+	while repo and repo[-1] in "\\/":
+		repo = repo[:-1]
+	repopaths = []
+	dirpaths = [os.path.dirname(os.path.dirname(store.rstrip("/")))]
+	while dirpaths:
+		dirpath = dirpaths.pop()
+		repopaths.append(dirpath + "/" + repo + "/")
+		subdirs, filenames = list_dir_sorted(dirpath)
+		for subdir in reversed(subdirs):
+			if subdir != repo and repo_exists(repo, dirpath + "/" + subdir):
+				dirpaths.append(dirpath + "/" + subdir)
+	return repopaths
+
+# Return the content of the blob with the given hash, applying
+# deltas as needed, or raise IOError if it's not in the store.
+def read_object(store, digest):
+	chain = []
+	while True:
+		if len(chain) > DELTA_MAX_DEPTH:
+			raise IOError("delta chain too long at " + digest)
+		kind, content = read_stored_object(store, digest)
+		if kind == b"F":
+			break
+		if kind == b"C":
+			content = b"".join(iter_object(store, digest))
+			break
+		pos = content.find(b"\n")
+		if content[:len(DELTA_HEADER)] != DELTA_HEADER or pos < 0:
+			raise IOError("damaged delta " + digest)
+		chain.append(content[pos+1:])
+		digest = content[len(DELTA_HEADER):pos].decode("ascii")
+	while chain:
+		content = apply_delta(content, chain.pop())
+	return content
+
+# Yield the content of the blob with the given hash, in pieces:
+# a chunk at a time for loose full blobs and chunked blobs, so
+# memory use doesn't depend on their size. Raise IOError as above.
+def iter_object(store, digest):
+	try:
+		f = open(object_path(store, digest), "rb")
+	except (IOError, OSError):
+		f = None
+	if f is not None:
+		while True:
+			piece = f.read(CHUNK_SIZE)
+			if not piece:
+				break
+			yield piece
+		f.close()
+		return
+	kind, content = read_stored_object(store, digest)
+	if kind == b"C":
+		for chunk_digest in get_object_refs(kind, content):
+			yield read_object(store, chunk_digest)
+	else:
+		yield read_object(store, digest)
+
+# Return (kind, data) of the object with the given hash as stored,
+# loose or packed, where kind is b"F" for a full blob, b"D" for
+# a delta, or b"C" for a list of chunks.
+# Raise IOError if it's not in the store.
+def read_stored_object(store, digest):
+	dest = object_path(store, digest)
+	for kind, path in ((b"F", dest), (b"D", dest + DELTA_SUFFIX), (b"C", dest + CHUNKS_SUFFIX)):
+		try:
+			f = open(path, "rb")
+		except (IOError, OSError):
+			continue
+		content = f.read()
+		f.close()
+		return kind, content
+	for pack in get_packs(store):
+		found = pack.read(digest)
+		if found:
+			return found
+	raise IOError("missing blob " + digest)
+
+# Replace the full blob old_digest, which was version number count
+# of a file, with a reverse delta from new_digest, the next version.
+# Keyframes, large blobs and blobs which don't shrink are left alone.
+# If commits is given, the delta is added to it rather than committed
+# here, as for store_object().
+# Return 1 if a delta was stored, else 0.
+def store_reverse_delta(store, old_digest, new_digest, count, commits = None):
+	if count % DELTA_KEYFRAME == 0 or old_digest == new_digest:
+		return 0
+	old_path = object_path(store, old_digest)
+	new_path = object_path(store, new_digest)
+	try:
+		old_size = os.path.getsize(old_path)
+		new_size = os.path.getsize(new_path)
+	except OSError:
+		return 0	# Not both stored in full, e.g. already a delta.
+	if old_size > DELTA_MAX_SIZE or new_size > DELTA_MAX_SIZE:
+		return 0
+	old = open(old_path, "rb").read()
+	delta = make_delta(open(new_path, "rb").read(), old)
+	if len(delta) >= old_size:
+		return 0
+	temp = temp_path(old_path + DELTA_SUFFIX)
+	open(temp, "wb").write(DELTA_HEADER + new_digest.encode("ascii") + b"\n" + delta)
+	if commits is None:
+		commit_files([(temp, old_path + DELTA_SUFFIX, old_path)])
+	else:
+		commits.append((temp, old_path + DELTA_SUFFIX, old_path))
+	return 1
+
+# Return a delta which turns base into target.
+# Runs of whole lines found in both are copied from base, while
+# the rest is inserted. Binary data just has arbitrary "lines".
+# Each copy is "C" then the offset and length in base,
+# each insert is "I" then the length and the data.
+# Base lines are indexed by content, like rsync's block checksums,
+# and each target line is looked up, preferring the base line after
+# the last copied, then the match is extended a line at a time. So
+# the time taken is linear in the sizes, not a full diff's quadratic.
+def make_delta(base, target):
+	base_lines = base.splitlines(True)
+	target_lines = target.splitlines(True)
+	offsets = [0]
+	first = {}
+	for i in range(len(base_lines)):
+		line = base_lines[i]
+		offsets.append(offsets[-1] + len(line))
+		if line not in first:
+			first[line] = i
+	delta = []
+	inserted = []
+	copy_start = copy_end = 0
+	expect = 0
+	j = 0
+	while j < len(target_lines):
+		line = target_lines[j]
+		if expect < len(base_lines) and base_lines[expect] == line:
+			i = expect
+		else:
+			i = first.get(line)
+			if i is None:
+				inserted.append(line)
+				j += 1
+				continue
+		start = i
+		while j < len(target_lines) and i < len(base_lines) and base_lines[i] == target_lines[j]:
+			i += 1
+			j += 1
+		expect = i
+		if offsets[i] - offsets[start] < DELTA_MIN_COPY and (inserted or offsets[start] != copy_end):
+			inserted.extend(target_lines[j-(i-start):j])
+			continue
+
+		# Flush what's gone before, joining copies which adjoin in base.
+		if inserted:
+			if copy_end > copy_start:
+				delta.append(b"C" + struct.pack(">QQ", copy_start, copy_end - copy_start))
+			data = b"".join(inserted)
+			delta.append(b"I" + struct.pack(">Q", len(data)) + data)
+			inserted = []
+			copy_start = copy_end = offsets[start]
+		elif offsets[start] != copy_end:
+			if copy_end > copy_start:
+				delta.append(b"C" + struct.pack(">QQ", copy_start, copy_end - copy_start))
+			copy_start = offsets[start]
+		copy_end = offsets[i]
+	if copy_end > copy_start:
+		delta.append(b"C" + struct.pack(">QQ", copy_start, copy_end - copy_start))
+	if inserted:
+		data = b"".join(inserted)
+		delta.append(b"I" + struct.pack(">Q", len(data)) + data)
+	return b"".join(delta)
+
+# Return the target which the delta (see make_delta) makes from base.
+def apply_delta(base, delta):
+	target = []
+	pos = 0
+	while pos < len(delta):
+		op = delta[pos:pos+1]
+		if op == b"C":
+			offset, length = struct.unpack(">QQ", delta[pos+1:pos+17])
+			target.append(base[offset:offset+length])
+			pos += 17
+		elif op == b"I":
+			length, = struct.unpack(">Q", delta[pos+1:pos+9])
+			target.append(delta[pos+9:pos+9+length])
+			pos += 9 + length
+		else:
+			raise IOError("damaged delta")
+	return b"".join(target)
+
+# Return the hash of a version stored in a repository.
+# Links into the object store are named by hash, so need not be read.
+# Full copies, as stored before the object store existed, are hashed.
+def get_version_hash(version_path):
+	if os.path.islink(version_path):
+		target = os.readlink(version_path).replace("\\", "/").split("/")
+		if len(target) >= 2 and target[-3:-2] == [OBJECTS_DIR[:-1]]:
+			return target[-2] + target[-1]
+	return hash_file(version_path)
+
+# Return 1 if the repository entry name looks like a stored version.
+def is_version_name(name):
+	if len(name) <= TIMESTAMP_LENGTH:
+		return 0
+	if name[:1] != "Y" or name[TIMESTAMP_LENGTH-1:TIMESTAMP_LENGTH] != "_":
+		return 0
+	return 1
+
+# The parts of a file's stat results which change when its content does.
+def get_fingerprint(status):
+	return (status.st_size, status.st_mtime_ns, status.st_ino, status.st_mode)
+
+# Read a repository's stat cache.
+# Return a dict mapping each filename to its (fingerprint, hash).
+def read_statcache(path):
+	statcache = {}
+	try:
+		lines = open(path, "rb").read().decode("utf-8", "surrogateescape").split("\n")
+	except (IOError, OSError):
+		return statcache
+	for line in lines:
+		fields = line.split(" ", 5)
+		if len(fields) != 6:
+			continue	# Blank or damaged line.
+		size, mtime_ns, ino, mode, digest, name = fields
+		try:
+			fingerprint = (int(size), int(mtime_ns), int(ino), int(mode))
+		except ValueError:
+			continue
+		statcache[name] = (fingerprint, digest)
+	return statcache
+
+# Replace a repository's stat cache with the given entries.
+# Entries for recently modified files are left out (see Stat cache above).
+def write_statcache(path, statcache):
+	racy_ns = time.time_ns() - STATCACHE_RACY_NS
+	text = ""
+	for name in sorted(statcache):
+		fingerprint, digest = statcache[name]
+		if fingerprint[1] >= racy_ns:
+			continue
+		text += "%d %d %d %d %s %s\n" % (fingerprint + (digest, name))
+	temp = temp_path(path)
+	try:
+		open(temp, "wb").write(text_bytes(text))
+		os.replace(temp, path)
+	except (IOError, OSError):
+		sys.stderr.write(THIS_PROGRAM + ": error: could not write " + path + "\n")
+
+# The versions stored in one repository (see Manifest above).
+class Manifest:
+	def __init__(self, repopath):
+		self.repopath = repopath
+		self.path = repopath + MANIFEST_FILE
+		self.latest_path = repopath + LATEST_FILE
+		self.length = 0			# Bytes of manifest reflected in self.latest.
+		self.latest = {}		# Name -> [version, hash, size, count, offset].
+		self.pending = []		# Lines not yet appended to the manifest.
+		self.history = None		# Name -> ([run, ...], [entry, ...]), if loaded.
+		self.latest_changed = 0
+
+	# Read the latest versions, bringing them up to date if needed.
+	# A repository from before the manifest existed is imported.
+	def load(self, store):
+		if not os.path.exists(self.path):
+			self.import_versions(store)
+			return
+		self.read_latest()
+		size = os.path.getsize(self.path)
+		if size < self.length:
+			# The manifest is only appended to, so this is odd.
+			sys.stderr.write(THIS_PROGRAM + ": error: rebuilding " + self.latest_path + "\n")
+			self.length = 0
+			self.latest = {}
+		if size != self.length:
+			self.replay(self.length)
+
+	def read_latest(self):
+		try:
+			lines = open(self.latest_path, "rb").read().decode("utf-8", "surrogateescape").split("\n")
+		except (IOError, OSError):
+			return
+		try:
+			self.length = int(lines[0])
+		except ValueError:
+			return
+		for line in lines[1:]:
+			fields = line.split(" ", 5)
+			if len(fields) != 6:
+				continue
+			version, digest, size, count, offset, name = fields
+			self.latest[name] = [version, digest, int(size), int(count), int(offset)]
+
+	# Apply manifest lines after the given offset to the latest versions.
+	def replay(self, offset):
+		f = open(self.path, "rb")
+		f.seek(offset)
+		for line in f:
+			entry = parse_manifest_line(line)
+			if line[-1:] != b"\n":
+				break	# Partly written, so it'll be overwritten.
+			if entry:
+				run, version, digest, size, prev, name = entry
+				count = 1
+				if name in self.latest:
+					count = self.latest[name][3] + 1
+				self.latest[name] = [version, digest, size, count, offset]
+			offset += len(line)
+		self.length = offset
+		self.latest_changed = 1
+
+	# Return the latest [version, hash, size, count, offset] of name, or None.
+	def get_latest(self, name):
+		return self.latest.get(name)
+
+	# Note a newly stored version. It's written out by save().
+	def add(self, run, version, digest, size, name):
+		run = run.rstrip("_")
+		version = version.rstrip("_")
+		offset = self.length
+		for line in self.pending:
+			offset += len(line)
+		prev = -1
+		count = 1
+		if name in self.latest:
+			prev = self.latest[name][4]
+			count = self.latest[name][3] + 1
+		line = "%s %s %s %d %d %s\n" % (run, version, digest, size, prev, name)
+		self.pending.append(text_bytes(line))
+		self.latest[name] = [version, digest, size, count, offset]
+		self.latest_changed = 1
+		if self.history is not None:
+			self.add_history(run, version, digest, size, name)
+
+	# Append any new versions to the manifest, then update latest.
+	def save(self):
+		if self.pending or not os.path.exists(self.path):
+			f = open(self.path, "ab")
+			f.truncate(self.length)		# Drop any partly written line.
+			f.write(b"".join(self.pending))
+			f.close()
+			for line in self.pending:
+				self.length += len(line)
+			self.pending = []
+		if not self.latest_changed:
+			return
+		text = "%d\n" % self.length
+		for name in sorted(self.latest):
+			text += "%s %s %d %d %d %s\n" % tuple(self.latest[name] + [name])
+		temp = temp_path(self.latest_path)
+		try:
+			open(temp, "wb").write(text_bytes(text))
+			os.replace(temp, self.latest_path)
+			self.latest_changed = 0
+		except (IOError, OSError):
+			sys.stderr.write(THIS_PROGRAM + ": error: could not write " + self.latest_path + "\n")
+
+	# Read the whole manifest, for looking up older versions.
+	def load_history(self):
+		if self.history is not None:
+			return
+		self.history = {}
+		try:
+			f = open(self.path, "rb")
+		except (IOError, OSError):
+			return
+		for line in f:
+			entry = parse_manifest_line(line)
+			if entry:
+				run, version, digest, size, prev, name = entry
+				self.add_history(run, version, digest, size, name)
+		for line in self.pending:
+			run, version, digest, size, prev, name = parse_manifest_line(line)
+			self.add_history(run, version, digest, size, name)
+
+	def add_history(self, run, version, digest, size, name):
+		if name not in self.history:
+			self.history[name] = ([], [])
+		runs, entries = self.history[name]
+		runs.append(run)
+		entries.append((run, version, digest, size))
+
+	# Return all (run, version, hash, size) of name, oldest first.
+	def get_versions(self, name):
+		self.load_history()
+		if name not in self.history:
+			return []
+		return self.history[name][1]
+
+	# Drop the oldest versions of names beyond the config's Retain
+	# limits, rewriting the manifest. Return how many were dropped.
+	def retain(self, config):
+		self.load_history()
+		drop = {}
+		for name in self.history:
+			count = config.get_retain(name)
+			versions = self.history[name][1]
+			if count is not None and len(versions) > count:
+				drop[name] = len(versions) - count
+		if not drop:
+			return 0
+
+		# Add back the versions kept, as if to an empty manifest.
+		history = self.history
+		self.history = None
+		self.length = 0
+		self.latest = {}
+		self.pending = []
+		for line in open(self.path, "rb"):
+			entry = parse_manifest_line(line)
+			if entry is None:
+				break
+			run, version, digest, size, prev, name = entry
+			if drop.get(name, 0) > 0:
+				drop[name] -= 1
+				continue
+			self.add(run, version, digest, size, name)
+		temp = temp_path(self.path)
+		open(temp, "wb").write(b"".join(self.pending))
+		os.replace(temp, self.path)
+		for line in self.pending:
+			self.length += len(line)
+		self.pending = []
+		self.save()
+		if os.path.exists(self.repopath + VERIFIED_FILE):
+			os.remove(self.repopath + VERIFIED_FILE)	# Its offset is no longer meaningful.
+
+		dropped = 0
+		for name in history:
+			dropped += len(history[name][1])
+		self.load_history()
+		for name in self.history:
+			dropped -= len(self.history[name][1])
+		return dropped
+
+	# Return 1 if the content with the given hash was ever stored as name.
+	def has_version(self, name, digest):
+		latest = self.get_latest(name)
+		if latest is not None and latest[1] == digest:
+			return 1
+		with Manifest_Lock:
+			versions = self.get_versions(name)
+		for version in versions:
+			if version[2] == digest:
+				return 1
+		return 0
+
+	# Return the (run, version, hash, size) of name which was
+	# latest at the given timestamp, or None if there was none. Walks
+	# back along name's versions rather than loading the whole history,
+	# so costs a seek per version newer than that (see Manifest above).
+	def get_version_as_of(self, name, when):
+		when = when.rstrip("_")
+		for run, version, digest, size, name in self.iter_versions(name):
+			if run <= when:
+				return (run, version, digest, size)
+		return None
+
+	# Yield the (run, version, hash, size, name) of each version of
+	# name, newest first. Each manifest line gives the offset of the
+	# line for the previous version, so only name's lines are read.
+	def iter_versions(self, name):
+		latest = self.get_latest(name)
+		if latest is None:
+			return
+		f = open(self.path, "rb")
+		offset = latest[4]
+		while offset >= 0:
+			f.seek(offset)
+			entry = parse_manifest_line(f.readline())
+			if entry is None or entry[5] != name or entry[4] >= offset:
+				sys.stderr.write(THIS_PROGRAM + ": error: damaged " + self.path + " at offset %d\n" % offset)
+				break
+			run, version, digest, size, offset, name = entry
+			yield (run, version, digest, size, name)
+		f.close()
+
+	# Yield the (run, version, hash, size, name) of each version stored
+	# by a run from since until until (either may be None), oldest first.
+	# Runs are appended in time order, so the first is binary searched.
+	def iter_runs(self, since, until):
+		f = open(self.path, "rb")
+		offset = 0
+		if since is not None:
+			offset = self.find_run(f, since)
+		f.seek(offset)
+		while offset < self.length:
+			line = f.readline()
+			offset += len(line)
+			entry = parse_manifest_line(line)
+			if entry is None:
+				continue
+			run, version, digest, size, prev, name = entry
+			if until is not None and run > until:
+				break
+			yield (run, version, digest, size, name)
+		f.close()
+
+	# Return the offset of the first line of the open manifest f whose
+	# run is at or after when, or the manifest's length if there's none.
+	def find_run(self, f, when):
+		when = text_bytes(when)
+		lo = 0					# The start of a line, not after the one sought.
+		hi = self.length		# The start of a line at or after when, or the end.
+		while lo < hi:
+			# Find the first line starting in the middle or after.
+			mid = (lo + hi) // 2
+			if mid > lo:
+				f.seek(mid - 1)
+				f.readline()
+				start = f.tell()
+			else:
+				start = lo
+			if start >= hi:
+				start = lo		# Only lo's line is left to look at.
+			f.seek(start)
+			line = f.readline()
+			if line.split(b" ", 1)[0] < when:
+				lo = start + len(line)
+			else:
+				hi = start
+		return lo
+
+	# Import versions stored as files named YyyyymmddThhmmssZ_filename.
+	# Full copies are moved into the object store. Once the manifest is
+	# saved, the files and links are removed, since it's authoritative.
+	def import_versions(self, store):
+		subdirs, filenames = list_dir_sorted(self.repopath)
+		versions = []
+		for d in filenames:
+			if is_version_name(d):
+				versions.append((d[:TIMESTAMP_LENGTH], d[TIMESTAMP_LENGTH:]))
+		if versions:
+			sys.stdout.write(THIS_PROGRAM + ": importing %d versions into %s\n" % (len(versions), self.path))
+		imported = []
+		for date, name in sorted(versions):
+			version_path = self.repopath + date + name
+			digest = get_version_hash(version_path)
+			size = os.stat(version_path).st_size
+			self.add(date, date, digest, size, name)
+			if not os.path.islink(version_path):
+				blob = object_path(store, digest)
+				if not object_exists(store, digest):
+					store_object(store, digest, version_path)
+				elif os.path.exists(blob) and files_differ(blob, version_path):
+					# Same hash, different bytes: keep both, for inspection.
+					sys.stderr.write(THIS_PROGRAM + ": error: " + version_path + " differs from " + blob + "\n")
+					continue
+			imported.append(version_path)
+		if not versions:
+			return
+		self.save()
+		forget_latest_counts(store)
+		for version_path in imported:
+			try:
+				os.remove(version_path)
+			except (IOError, OSError) as e:
+				sys.stderr.write(THIS_PROGRAM + ": error: could not remove " + version_path + ": " + str(e) + "\n")
+
+Manifest_Lock = threading.Lock()	# For loading history from worker threads.
+
+# Parse a manifest line.
+# Return (run, version, hash, size, prev, name) or None if it's damaged.
+def parse_manifest_line(line):
+	if line[-1:] != b"\n":
+		return None	# Partly written.
+	fields = line[:-1].decode("utf-8", "surrogateescape").split(" ", 5)
+	if len(fields) != 6:
+		return None
+	run, version, digest, size, prev, name = fields
+	try:
+		return (run, version, digest, int(size), int(prev), name)
+	except ValueError:
+		return None
+
+# Runs tasks on up to a given number of threads (including the caller's).
+# When every thread is busy, a task is run immediately by its caller.
+# So a task may wait for the tasks it spawns without risk of deadlock:
+# each of those has either finished already or has its own thread.
+class Workers:
+	def __init__(self, count):
+		self.slots = None
+		if count > 1:
+			self.slots = threading.BoundedSemaphore(count - 1)
+
+	# Start running function(*args). Return a Task to get its result.
+	def spawn(self, function, *args):
+		task = Task(function, args)
+		if self.slots and self.slots.acquire(False):
+			thread = threading.Thread(target=task.run, args=(self.slots,))
+			thread.daemon = True
+			thread.start()
+		else:
+			task.run(None)
+		return task
+
+class Task:
+	def __init__(self, function, args):
+		self.function = function
+		self.args = args
+		self.value = None
+		self.error = None
+		self.done = threading.Event()
+
+	def run(self, slots):
+		try:
+			self.value = self.function(*self.args)
+		except BaseException:
+			self.error = sys.exc_info()[1]
+		if slots:
+			slots.release()
+		self.done.set()
+
+	# Wait for the task to finish. Return its result, or raise its error.
+	def result(self):
+		self.done.wait()
+		if self.error is not None:
+			raise self.error
+		return self.value
+
+# Stores blobs on a thread of its own, in batches (see Object store).
+class Writer:
+	def __init__(self):
+		self.queue = queue.Queue(WRITER_QUEUE_SIZE)
+		self.error = None
+		self.deltas = []	# (store, old hash, new hash, count) to replace by deltas.
+		self.failed = set()	# (store, hash) of files which changed as they were stored.
+		self.counts = {}	# Store -> its latest counts, or None if they're to be rebuilt.
+		self.unsaved = set()	# Stores whose latest counts file has been removed.
+		thread = threading.Thread(target=self.run)
+		thread.daemon = True
+		thread.start()
+
+	# Queue storing the blob with the given hash, from the file at path
+	# (with the given stat results) or from content, and as chunks if
+	# chunked is set. If latest [version, hash, size, count, offset] of
+	# the same name is given, its blob may later be replaced by a reverse
+	# delta (see store_deltas). Waits while the queue is full.
+	def store(self, store, digest, path, content, status, chunked, latest):
+		self.queue.put((store, digest, path, content, status, chunked, latest))
+
+	# Wait until everything queued so far is stored.
+	# Raise the first error met in storing, if any.
+	def flush(self):
+		done = threading.Event()
+		self.queue.put(done)
+		done.wait()
+		if self.error is not None:
+			raise self.error
+
+	def run(self):
+		while True:
+			batch = [self.queue.get()]
+			while True:
+				try:
+					batch.append(self.queue.get_nowait())
+				except queue.Empty:
+					break
+			try:
+				if self.error is None:
+					self.store_batch([job for job in batch if not isinstance(job, threading.Event)])
+			except BaseException:
+				self.error = sys.exc_info()[1]
+			for job in batch:
+				if isinstance(job, threading.Event):
+					job.set()
+
+	# Store blobs, committing them together, and note their previous
+	# versions to be replaced by deltas, or which files changed as they
+	# were stored.
+	def store_batch(self, jobs):
+		commits = []
+		for store, digest, path, content, status, chunked, latest in jobs:
+			if chunked:
+				stored = store_chunked(store, digest, path, commits)
+			else:
+				stored = store_object(store, digest, path, content, status, commits)
+			if stored < 0:
+				self.failed.add((store, digest))
+				continue
+			if latest is not None:
+				self.deltas.append((store, latest[1], digest, latest[3]))
+			self.count_latest(store, latest and latest[1], digest)
+		commit_files(commits)
+
+	# Count a name's latest version changing from old_digest (None for
+	# a new name) to new_digest. The store's latest counts file is
+	# removed until store_deltas() writes it again.
+	def count_latest(self, store, old_digest, new_digest):
+		if store not in self.counts:
+			self.counts[store] = read_latest_counts(store)
+		if store not in self.unsaved:
+			if os.path.exists(store + LATEST_COUNTS_FILE):
+				os.remove(store + LATEST_COUNTS_FILE)
+			self.unsaved.add(store)
+		counts = self.counts[store]
+		if counts is None:
+			return
+		if old_digest is not None:
+			counts[old_digest] = counts.get(old_digest, 0) - 1
+			if counts[old_digest] <= 0:
+				del counts[old_digest]
+		counts[new_digest] = counts.get(new_digest, 0) + 1
+
+	# Return 1 if the blob with the given hash was to be stored from a
+	# file which changed as it was stored, so it isn't there, else 0.
+	# Call flush() first.
+	def has_failed(self, store, digest):
+		if (store, digest) not in self.failed or object_exists(store, digest):
+			return 0
+		return 1
+
+	# Once a run's manifests are saved, replace the previous versions of
+	# what it stored by reverse deltas, except for any blob which is still
+	# the latest version of some name sharing the object store.
+	# Then write the latest counts again, rebuilding them if need be.
+	def store_deltas(self, repo):
+		self.flush()
+		stores = {}
+		for store, old_digest, new_digest, count in self.deltas:
+			stores.setdefault(store, []).append((old_digest, new_digest, count))
+		self.deltas = []
+		for store in self.unsaved | Stale_Latest_Counts:
+			if self.counts.get(store) is None or store in Stale_Latest_Counts:
+				self.counts[store] = count_latest_digests(store, repo)
+				Stale_Latest_Counts.discard(store)
+			counts = self.counts[store]
+			commits = []
+			for old_digest, new_digest, count in stores.get(store, []):
+				if old_digest not in counts:
+					store_reverse_delta(store, old_digest, new_digest, count, commits)
+			commit_files(commits)
+			write_latest_counts(store, counts)
+		self.unsaved = set()
+
+# A temporary name next to path, unique to this process and thread,
+# for writing a file which will then be renamed to path.
+def temp_path(path):
+	return path + ".tmp%d.%d" % (os.getpid(), threading.current_thread().ident)
+
+# Read a subdirectory's tree cache.
+# Return ([(path, fingerprint), ...], summary, config file's hash),
+# or None if there's none.
+def read_treecache(path):
+	try:
+		lines = open(path, "rb").read().decode("utf-8", "surrogateescape").split("\n")
+		count, config_digest = lines[0].split(" ")
+		count = int(count)
+		covered = []
+		for line in lines[1:count+1]:
+			size, mtime_ns, ino, mode, relpath = line.split(" ", 4)
+			covered.append((relpath, (int(size), int(mtime_ns), int(ino), int(mode))))
+		return covered, "\n".join(lines[count+1:]), config_digest
+	except (IOError, OSError, ValueError):
+		return None
+
+# Replace a subdirectory's tree cache. It's removed instead if anything
+# was modified too recently to be sure of noticing further changes.
+# The config file's hash is kept too, as it affects what's tracked.
+def write_treecache(path, covered, text, config_digest):
+	racy_ns = time.time_ns() - STATCACHE_RACY_NS
+	lines = ["%d %s" % (len(covered), config_digest)]
+	for relpath, fingerprint in covered:
+		if fingerprint[1] >= racy_ns:
+			if os.path.exists(path):
+				os.remove(path)
+			return
+		lines.append("%d %d %d %d %s" % (fingerprint + (relpath,)))
+	temp = temp_path(path)
+	try:
+		open(temp, "wb").write(text_bytes("\n".join(lines) + "\n" + text))
+		os.replace(temp, path)
+	except (IOError, OSError):
+		sys.stderr.write(THIS_PROGRAM + ": error: could not write " + path + "\n")
+
+# Return 1 if every covered entry under dirpath has the same stat results.
+def is_tree_unchanged(dirpath, covered):
+	for relpath, fingerprint in covered:
+		try:
+			if get_fingerprint(os.stat(dirpath + "/" + relpath)) != fingerprint:
+				return 0
+		except OSError:
+			return 0
+	return 1
+
+# Return covered entries as seen from the directory above them.
+def prefix_covered(name, covered):
+	return [(name + "/" + relpath, fingerprint) for relpath, fingerprint in covered]
+
 def repo_exists(repo, dirpath = "."):
 	subdirs, filenames = list_dir_sorted(dirpath)
 	while repo and repo[-1] in "\\/":
@@ -414,9 +2799,9 @@ def is_readable_file(path):
 	except:
 		return 0
 
-def get_mode_str(path):
+# Return the permissions in the stat results, like "ls -l" does.
+def get_mode_str(status):
 	s = ""
-	status = os.stat(path)
 	if stat.S_ISDIR(status.st_mode):    s += 'd'
 	else:                               s += '-'
 
@@ -443,8 +2828,117 @@ def get_mode_str(path):
 
 	return s
 
+# Return the hash of the file at path.
+def hash_file(path):
+	return read_and_hash(path)[0]
+
+# Return the hash of the file at path, and its content if that fits
+# within one chunk (else None). Larger files are read in chunks,
+# so memory use doesn't depend on their size.
+def read_and_hash(path):
+	h = hashlib.sha384()
+	f = open(path, "rb")
+	content = f.read(CHUNK_SIZE)
+	h.update(content)
+	while True:
+		chunk = f.read(CHUNK_SIZE)
+		if not chunk:
+			break
+		h.update(chunk)
+		content = None
+	f.close()
+	return base64.urlsafe_b64encode(h.digest()).decode("ascii"), content
+
+# Return 1 if the two files' contents differ, else 0.
+# They're compared a chunk at a time, stopping at the first difference.
+def files_differ(path1, path2):
+	if os.path.getsize(path1) != os.path.getsize(path2):
+		return 1
+	f1 = open(path1, "rb")
+	f2 = open(path2, "rb")
+	differ = 0
+	while not differ:
+		chunk1 = f1.read(CHUNK_SIZE)
+		chunk2 = f2.read(CHUNK_SIZE)
+		if chunk1 != chunk2:
+			differ = 1
+		elif not chunk1:
+			break
+	f1.close()
+	f2.close()
+	return differ
+
+# Copy a file, keeping its permissions and timestamps, like "cp -p".
+# If the file's content has already been read, it's written from that,
+# and if it's already been stat'ed, its permissions and timestamps
+# are taken from those stat results.
+def copy_file(src_path, dest_path, content = None, status = None):
+	if content is not None:
+		open(dest_path, "wb").write(content)
+	else:
+		src = open(src_path, "rb")
+		dest = open(dest_path, "wb")
+		try:
+			copy_fd(src.fileno(), dest.fileno())
+		finally:
+			dest.close()
+			src.close()
+	try:
+		if status is not None:
+			os.chmod(dest_path, stat.S_IMODE(status.st_mode))
+			os.utime(dest_path, ns = (status.st_atime_ns, status.st_mtime_ns))
+		else:
+			shutil.copystat(src_path, dest_path)
+	except OSError:
+		pass	# Content matters more than its metadata.
+
+# Copy all data from one open file to another, using whichever is
+# the fastest method that works here: a copy-on-write clone (reflink)
+# sharing the data blocks, then a copy within the kernel, then lastly
+# copying a chunk at a time through Python.
+def copy_fd(src, dest):
+	if fcntl and USING_LINUX:
+		try:
+			fcntl.ioctl(dest, FICLONE, src)
+			return
+		except (IOError, OSError):
+			pass	# Not supported by this filesystem.
+	for kernel_copy in (copy_file_range_fd, sendfile_fd):
+		try:
+			if kernel_copy(src, dest):
+				return
+		except (OSError, AttributeError):
+			pass	# Continue from wherever that copy got to.
+	while True:
+		chunk = os.read(src, CHUNK_SIZE)
+		if not chunk:
+			break
+		while chunk:
+			chunk = chunk[os.write(dest, chunk):]
+
+def copy_file_range_fd(src, dest):
+	while os.copy_file_range(src, dest, KERNEL_COPY_SIZE):
+		pass
+	return 1
+
+def sendfile_fd(src, dest):
+	offset = os.lseek(src, 0, os.SEEK_CUR)
+	while True:
+		sent = os.sendfile(dest, src, offset, KERNEL_COPY_SIZE)
+		if not sent:
+			break
+		offset += sent
+	os.lseek(src, offset, os.SEEK_SET)
+	return 1
+
+# Filenames which can't be decoded are kept as-is in bytes.
+def text_bytes(text):
+	if isinstance(text, bytes):
+		return text
+	return text.encode("utf-8", "surrogateescape")
+
 def hash384base64(bytes):
-    return base64.urlsafe_b64encode(hashlib.sha384(bytes).digest())
+    return base64.urlsafe_b64encode(hashlib.sha384(text_bytes(bytes)).digest()).decode("ascii")
 
 if __name__ == '__main__':
 	main()
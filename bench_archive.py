@@ -0,0 +1,283 @@
+#!/usr/bin/python
+
+#
+# Benchmark Archive.py against synthetic directory trees.
+#
+# Usage:
+#
+#  bench_archive.py [options]
+#
+#		Generate a tree of files in a temporary directory, then time
+#		Archive.py archiving it: first when nothing is archived yet,
+#		then again with nothing changed, then after each of several
+#		rounds of changes. The results are written as JSON.
+#
+# Options:
+#
+# --files N         Number of files to generate (default 1000).
+# --depth N         Levels of subdirectories below the top (default 2).
+# --fanout N        Subdirectories in each directory above the bottom (default 3).
+# --repos N         Subdirectories holding repositories (default all).
+# --min-size N      Smallest file size in bytes (default 100).
+# --max-size N      Largest file size in bytes (default 1000000).
+# --churn P         Percent of files changed in each round (default 5).
+# --rounds N        Rounds of changes to archive (default 3).
+# --seed N          Seed for generating the tree and changes (default 1).
+# -j N              Pass "-j N" to Archive.py.
+# --archive PATH    The Archive.py to benchmark (default the one beside this).
+# --dir PATH        Generate the tree there rather than in a temporary
+#                   directory; it's left in place afterwards.
+# --output PATH     Write the JSON results there instead of to stdout.
+# --compare PATH    Also compare with earlier results saved by --output.
+#
+# The tree:
+#
+# Directories form a tree, each with --fanout subdirectories, down to
+# --depth levels. The first --repos of them, taken level by level, hold
+# repositories, so each is reached through directories which all hold
+# repositories, as Archive.py requires. Files are spread over every
+# directory at random, including those without repositories, which
+# Archive.py should skip. File sizes are spread evenly on a log scale
+# between --min-size and --max-size, and contents are random bytes.
+#
+# Each round of changes overwrites part of --churn percent of the files
+# (chosen at random), appends to as many more, and adds and deletes a
+# tenth as many. Modification times of files and directories (but not
+# repositories) are set well in the past, so that Archive.py's caches
+# (which ignore very recently modified files) work as they would on
+# files edited some time before archiving.
+#
+# Measurements:
+#
+# For each run of Archive.py: elapsed, user and system seconds, its peak
+# resident set size (from os.wait4), blocks it wrote (from the same
+# resource usage, in bytes; 0 where the filesystem doesn't count them),
+# and how much the repositories grew, in bytes. Results also record the
+# options, the Python version, and a hash of the Archive.py benchmarked,
+# so results from different versions can be told apart and compared.
+# Comparing reports each run's change in elapsed time and peak RSS, and
+# flags those more than COMPARE_TOLERANCE worse.
+#
+
+
+import os, sys, time
+import hashlib, json, random, shutil, subprocess, tempfile
+
+THIS_PROGRAM = "bench_archive.py"
+ARCHIVE_PROGRAM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Archive.py")
+REPO_DIRNAME = ".Archive"
+
+OPTIONS = {
+		"--files":    1000,
+		"--depth":    2,
+		"--fanout":   3,
+		"--repos":    -1,		# All.
+		"--min-size": 100,
+		"--max-size": 1000000,
+		"--churn":    5,
+		"--rounds":   3,
+		"--seed":     1,
+		"-j":         0,		# Archive.py's default.
+	}
+PATH_OPTIONS = ["--archive", "--dir", "--output", "--compare"]
+
+PAST_SECONDS = 24 * 60 * 60		# How far back modification times are set.
+COMPARE_TOLERANCE = 0.10		# Worse by more than this is flagged.
+
+def main():
+	params = parse_args(sys.argv[1:])
+	if params is None:
+		sys.exit(2)
+
+	rng = random.Random(params["--seed"])
+	top = params["--dir"]
+	if top is None:
+		top = tempfile.mkdtemp(prefix = "bench_archive.")
+	try:
+		dirpaths = make_dirs(top, params)
+		files = {}
+		for i in range(params["--files"]):
+			add_file(top, dirpaths, files, rng, params, "f%d" % i, 0)
+		for dirpath in dirpaths:
+			set_past_mtime(os.path.join(top, dirpath), 0)
+
+		runs = []
+		runs.append(run_archive("first", top, params))
+		runs.append(run_archive("noop", top, params))
+		for turn in range(1, params["--rounds"] + 1):
+			change_files(top, dirpaths, files, rng, params, turn)
+			for dirpath in dirpaths:
+				set_past_mtime(os.path.join(top, dirpath), turn)
+			runs.append(run_archive("incremental_%d" % turn, top, params))
+	finally:
+		if params["--dir"] is None:
+			shutil.rmtree(top, ignore_errors = True)
+
+	results = {
+			"archive": params["--archive"],
+			"archive_hash": hash_file(params["--archive"])[:16],
+			"python": sys.version.split()[0],
+			"params": dict((name.lstrip("-"), params[name]) for name in OPTIONS),
+			"runs": runs,
+		}
+	text = json.dumps(results, indent = 1, sort_keys = True) + "\n"
+	if params["--output"]:
+		open(params["--output"], "w").write(text)
+	else:
+		sys.stdout.write(text)
+	if params["--compare"]:
+		compare(json.load(open(params["--compare"])), results)
+
+# Return a dictionary of every option's value, given or default,
+# or None if the arguments weren't understood.
+def parse_args(args):
+	params = dict(OPTIONS)
+	for name in PATH_OPTIONS:
+		params[name] = None
+	params["--archive"] = ARCHIVE_PROGRAM
+	while args:
+		arg = args.pop(0)
+		if (arg not in OPTIONS and arg not in PATH_OPTIONS) or not args:
+			sys.stderr.write(THIS_PROGRAM + ": error: usage: " + THIS_PROGRAM + " [" + "|".join(sorted(OPTIONS) + PATH_OPTIONS) + " value]...\n")
+			return None
+		value = args.pop(0)
+		if arg in PATH_OPTIONS:
+			params[arg] = value
+			continue
+		try:
+			params[arg] = int(value)
+		except ValueError:
+			sys.stderr.write(THIS_PROGRAM + ": error: " + arg + " needs a number, not " + value + "\n")
+			return None
+	if params["--min-size"] < 0 or params["--max-size"] < params["--min-size"]:
+		sys.stderr.write(THIS_PROGRAM + ": error: bad file sizes\n")
+		return None
+	return params
+
+# Make the directory tree under top, with repositories as described
+# above. Return the paths of every directory, relative to top.
+def make_dirs(top, params):
+	dirpaths = ["."]
+	level = ["."]
+	for depth in range(params["--depth"]):
+		below = []
+		for dirpath in level:
+			for i in range(params["--fanout"]):
+				below.append(os.path.join(dirpath, "d%d" % i))
+		dirpaths.extend(below)
+		level = below
+	repos = params["--repos"]
+	if repos < 0:
+		repos = len(dirpaths) - 1
+	for i, dirpath in enumerate(dirpaths):
+		os.makedirs(os.path.join(top, dirpath, REPO_DIRNAME) if i <= repos else os.path.join(top, dirpath), exist_ok = True)
+	return dirpaths
+
+# Write a new file of random size and content in a random directory,
+# and note its path and size in files.
+def add_file(top, dirpaths, files, rng, params, name, turn):
+	lo = max(params["--min-size"], 1)
+	hi = max(params["--max-size"], 1)
+	size = int(lo * (hi / lo) ** rng.random())
+	if params["--min-size"] == 0 and rng.random() < 0.01:
+		size = 0
+	path = os.path.join(rng.choice(dirpaths), name)
+	open(os.path.join(top, path), "wb").write(rng.randbytes(size))
+	set_past_mtime(os.path.join(top, path), turn)
+	files[path] = size
+
+# Make one round of changes, as described above.
+def change_files(top, dirpaths, files, rng, params, turn):
+	count = max(1, len(files) * params["--churn"] // 100)
+	paths = sorted(files)
+	for path in rng.sample(paths, min(count, len(paths))):
+		# Overwrite part of the file, in place.
+		size = files[path]
+		length = min(size, max(1, size // 100))
+		f = open(os.path.join(top, path), "r+b")
+		f.seek(rng.randrange(size - length + 1))
+		f.write(rng.randbytes(length))
+		f.close()
+		set_past_mtime(os.path.join(top, path), turn)
+	for path in rng.sample(paths, min(count, len(paths))):
+		# Append to the file.
+		length = max(1, files[path] // 100)
+		open(os.path.join(top, path), "ab").write(rng.randbytes(length))
+		files[path] += length
+		set_past_mtime(os.path.join(top, path), turn)
+	for path in rng.sample(paths, min(max(1, count // 10), len(paths))):
+		os.remove(os.path.join(top, path))
+		del files[path]
+	for i in range(max(1, count // 10)):
+		add_file(top, dirpaths, files, rng, params, "r%d_%d" % (turn, i), turn)
+
+# Set a file's (or directory's) modification time well in the past, but later each round
+# (turn is the round's number, 0 for the generated tree),
+# so a changed file's time differs from when it was last archived.
+def set_past_mtime(path, turn):
+	when = time.time() - PAST_SECONDS + turn * 60
+	os.utime(path, (when, when))
+
+# Run Archive.py in top and return its measurements, named name.
+def run_archive(name, top, params):
+	command = [sys.executable, params["--archive"]]
+	if params["-j"]:
+		command += ["-j", str(params["-j"])]
+	before = get_repos_size(top)
+	started = time.perf_counter()
+	process = subprocess.Popen(command, cwd = top, stdout = subprocess.DEVNULL)
+	pid, status, usage = os.wait4(process.pid, 0)
+	elapsed = time.perf_counter() - started
+	process.returncode = os.waitstatus_to_exitcode(status)
+	if process.returncode:
+		sys.stderr.write(THIS_PROGRAM + ": error: " + name + " run of Archive.py exited with %d\n" % process.returncode)
+	run = {
+			"name": name,
+			"seconds": round(elapsed, 4),
+			"user_seconds": round(usage.ru_utime, 4),
+			"system_seconds": round(usage.ru_stime, 4),
+			"max_rss_kb": usage.ru_maxrss,
+			"write_bytes": usage.ru_oublock * 512,
+			"repos_bytes_added": get_repos_size(top) - before,
+			"exit_status": process.returncode,
+		}
+	sys.stderr.write(THIS_PROGRAM + ": %s: %.3f seconds, %d KB peak RSS\n" % (name, elapsed, usage.ru_maxrss))
+	return run
+
+# Return the total size of every file in every repository under top.
+def get_repos_size(top):
+	total = 0
+	for dirpath, dirnames, filenames in os.walk(top):
+		if REPO_DIRNAME in dirpath.split(os.sep):
+			for name in filenames:
+				try:
+					total += os.lstat(os.path.join(dirpath, name)).st_size
+				except OSError:
+					pass	# Removed while looking, e.g. a temporary file.
+	return total
+
+# Report how each run changed between the old results and the new.
+def compare(old, new):
+	sys.stdout.write("Comparing Archive.py %s with %s\n" % (old.get("archive_hash"), new.get("archive_hash")))
+	if old.get("params") != new.get("params"):
+		sys.stdout.write("Warning: the benchmarks' options differ\n")
+	old_runs = dict((run["name"], run) for run in old.get("runs", []))
+	for run in new["runs"]:
+		old_run = old_runs.get(run["name"])
+		if old_run is None:
+			continue
+		line = "%-16s" % run["name"]
+		for key in ("seconds", "max_rss_kb"):
+			change = 0.0
+			if old_run[key]:
+				change = float(run[key]) / old_run[key] - 1
+			line += "  %s %s -> %s (%+.1f%%)" % (key, old_run[key], run[key], change * 100)
+			if change > COMPARE_TOLERANCE:
+				line += " WORSE"
+		sys.stdout.write(line + "\n")
+
+def hash_file(path):
+	return hashlib.sha384(open(path, "rb").read()).hexdigest()
+
+if __name__ == "__main__":
+	main()
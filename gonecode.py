@@ -6,8 +6,26 @@
 # Recursively walks down the directory tree from the current dir.
 # Finds all ".go" source files and analyses them looking for orphan funcs and types.
 # Only using a simplistic text search.
+# Each file is read once, into a record of its lines and the words on
+# each line, which every analysis then scans instead of the file.
+# With -j N, files are analysed by N worker processes, and their results
+# merged in path order, so the output is the same as without.
+# With --cache FILE, each file's results are kept in FILE along with its
+# size and modification time, and only files which have changed since
+# are analysed again.
+# With --find-unreachable, funcs, types and vars are reported as unused
+# unless reachable from an entry point: main, init, Test and Benchmark
+# funcs and such, and exported names, through the names which each
+# declaration refers to. So funcs only called by unused funcs are found.
+# With --index FILE, declarations, the sites of uses and imports are also
+# written to an SQLite database in FILE, for queries such as:
+#	SELECT path, line FROM uses JOIN files ON file = id WHERE name = 'X'
+#	SELECT DISTINCT imported FROM imports WHERE package = 'P'
+#	SELECT name FROM decls WHERE kind = 'func' AND receiver IN ('T', '*T') AND used = 0
+# Only the rows of files which have changed since are written again.
 
 import os, sys, string
+import multiprocessing, pickle, sqlite3, time
 
 Invalid_Prefixes = [
 		".git",
@@ -34,15 +52,57 @@ Print_Line_Counts   = 1
 Print_Unused_Funcs  = 1
 Print_Unused_Types  = 1
 Print_Unused_Vars   = 1
+Find_Unreachable    = 0
+Index_Paths         = set()	# Set by --index, to find the sites of uses in these files too.
+
+Root_Names = [
+		"main",
+		"init",
+	]
+
+Root_Prefixes = [
+		"Test",
+		"Benchmark",
+		"Example",
+		"Fuzz",
+	]
+
+CACHE_VERSION = 4								# Changes whenever analyse_file()'s results do.
+CACHE_RACY_NS = 2 * 1000 * 1000 * 1000			# Files modified this recently aren't cached.
+INDEX_VERSION = 1								# Changes whenever the index's tables do.
+
+Index_Tables = [
+		"CREATE TABLE files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime_ns INTEGER, lines INTEGER, bytes INTEGER)",
+		"CREATE TABLE decls (name TEXT, kind TEXT, receiver TEXT, file INTEGER, line INTEGER, used INTEGER)",
+		"CREATE TABLE uses (name TEXT, file INTEGER, line INTEGER)",
+		"CREATE TABLE imports (package TEXT, imported TEXT, file INTEGER)",
+	]
+
+# Made after the rows are first written, which is quicker than updating them for each row.
+Index_Indexes = [
+		"CREATE INDEX IF NOT EXISTS decls_name ON decls (name)",
+		"CREATE INDEX IF NOT EXISTS decls_receiver ON decls (receiver)",
+		"CREATE INDEX IF NOT EXISTS decls_file ON decls (file)",
+		"CREATE INDEX IF NOT EXISTS uses_name ON uses (name)",
+		"CREATE INDEX IF NOT EXISTS uses_file ON uses (file)",
+		"CREATE INDEX IF NOT EXISTS imports_package ON imports (package)",
+		"CREATE INDEX IF NOT EXISTS imports_imported ON imports (imported)",
+		"CREATE INDEX IF NOT EXISTS imports_file ON imports (file)",
+	]
 
 def main():
 	global Ignore_Test_Files, Ignore_Test_Funcs
 	global Print_All_Funcs, Print_All_Types, Print_All_Vars, Print_All_Paths, Print_Import_Cycles
-	global Print_Line_Counts, Print_Unused_Funcs, Print_Unused_Types, Print_Unused_Vars
+	global Print_Line_Counts, Print_Unused_Funcs, Print_Unused_Types, Print_Unused_Vars, Find_Unreachable
 
 	root = ""
 	dirname = "."
-	for arg in sys.argv[1:]:
+	jobs = 1
+	cache_path = ""
+	index_path = ""
+	args = sys.argv[1:]
+	while args:
+		arg = args.pop(0)
 		if is_param(arg, "--ignore-test-files"):   Ignore_Test_Files   ^= 1; continue
 		if is_param(arg, "--ignore-test-funcs"):   Ignore_Test_Funcs   ^= 1; continue
 		if is_param(arg, "--print-all-funcs"):     Print_All_Funcs     ^= 1; continue
@@ -54,6 +114,25 @@ def main():
 		if is_param(arg, "--print-unused-funcs"):  Print_Unused_Funcs  ^= 1; continue
 		if is_param(arg, "--print-unused-types"):  Print_Unused_Types  ^= 1; continue
 		if is_param(arg, "--print-unused-vars"):   Print_Unused_Vars   ^= 1; continue
+		if is_param(arg, "--find-unreachable"):    Find_Unreachable    ^= 1; continue
+		if arg[:2] == "-j":
+			value = arg[2:]
+			if not value and args:
+				value = args.pop(0)
+			if not value.isdigit() or int(value) < 1:
+				print("Bad number of jobs: " + value); return
+			jobs = int(value)
+			continue
+		if is_param(arg, "--cache"):
+			if not args:
+				print("Missing cache file after " + arg); return
+			cache_path = args.pop(0)
+			continue
+		if is_param(arg, "--index"):
+			if not args:
+				print("Missing index file after " + arg); return
+			index_path = args.pop(0)
+			continue
 		if arg[:2] == "--": print("Unknown directive: " + arg); return
 
 		# Default is to use a command-line argument as the root of the search.
@@ -61,6 +140,35 @@ def main():
 
 	paths = recursively_find_source_files({}, root, os.listdir(dirname))
 
+	fingerprints = {}
+	if cache_path or index_path:
+		fingerprints = get_fingerprints(paths)
+
+	index = None
+	indexed = {}
+	if index_path:
+		index = open_index(index_path)
+		if index is None:
+			return
+		indexed = read_indexed_files(index)
+		for path in paths:
+			if indexed.get(path) != fingerprints[path]:
+				Index_Paths.add(path)
+
+	# Files whose rows in the index are out of date are analysed again,
+	# even if cached, since the sites of uses aren't cached.
+	cache = {}
+	usable_cache = {}
+	if cache_path:
+		cache = read_cache(cache_path)
+		usable_cache = cache
+		if index:
+			usable_cache = {}
+			for path in cache:
+				if path not in Index_Paths:
+					usable_cache[path] = cache[path]
+	new_cache = {}
+
 	total_files = 0
 	total_lines = 0
 	total_bytes = 0
@@ -68,41 +176,61 @@ def main():
 	all_funcs = {}
 	all_types = {}
 	all_vars  = {}
-	for path in sorted(paths):
+	imports   = {}
+	all_uses  = {}
+	all_refs  = {}
+	for path, result in analyse_files(sorted(paths), jobs, usable_cache, fingerprints):
 		if Print_All_Paths:
 			print(path)
-		num_lines, num_bytes = count_lines_and_bytes(path)
-		find_funcs(path, all_funcs)
-		find_types(path, all_types)
-		find_vars(path, all_vars)
+		if cache_path:
+			new_cache[path] = (fingerprints[path], result[:-1] + (None,))
+		if path in Index_Paths:
+			index_file(index, path, fingerprints[path], result)
+		num_lines, num_bytes, funcs, types, vars, import_pairs, uses, refs, sites = result
+		merge_decls(all_funcs, funcs)
+		merge_decls(all_types, types)
+		merge_decls(all_vars, vars)
+		if Print_Import_Cycles:
+			find_imports(import_pairs, imports, ignore_common_paths)
+		if Print_Unused_Funcs or Print_Unused_Types or Print_Unused_Vars:
+			all_uses[path] = uses
+			all_refs[path] = refs
 		total_files += 1
 		total_lines += num_lines
 		total_bytes += num_bytes
 
-	imports = {}
-	if Print_Import_Cycles:
-		for path in sorted(paths):
-			find_imports(path, imports, ignore_common_paths)
-
-	used_funcs = {}
-	if Print_Unused_Funcs:
-		for path in sorted(paths):
-			find_funcs(path, all_funcs, used_funcs)
-
-	used_types = {}
-	if Print_Unused_Types:
-		for path in sorted(paths):
-			find_types(path, all_types, used_types)
-
-	used_vars = {}
-	if Print_Unused_Vars:
-		for path in sorted(paths):
-			find_vars(path, all_vars, used_vars)
+	if cache_path and new_cache != cache:
+		write_cache(cache_path, new_cache)
+
+	used_funcs = set()
+	used_types = set()
+	used_vars  = set()
+	if Find_Unreachable:
+		if Print_Unused_Funcs or Print_Unused_Types or Print_Unused_Vars:
+			used_funcs = used_types = used_vars = find_reachable(all_funcs.keys() | all_types.keys() | all_vars.keys(), all_refs)
+	else:
+		if Print_Unused_Funcs:
+			used_funcs = find_used(all_funcs, all_uses, 0)
+		if Print_Unused_Types:
+			used_types = find_used(all_types, all_uses, 1)
+		if Print_Unused_Vars:
+			used_vars = find_used(all_vars, all_uses, 2)
+
+	if index:
+		unindex_removed_files(index, indexed, paths)
+		index_used(index, "func", used_funcs, Print_Unused_Funcs)
+		index_used(index, "type", used_types, Print_Unused_Types)
+		index_used(index, "var", used_vars, Print_Unused_Vars)
+		for statement in Index_Indexes:
+			index.execute(statement)
+		index.commit()
+		index.close()
 
 	if Print_Import_Cycles:
-		sorted_list, err = topological_sort(imports)
-		if err:
-			print("Import Cycle:\n\t" + repr(err[1]))
+		for cycle, path in find_cycles(imports):
+			print("Import Cycle:")
+			print("\t" + " ".join(cycle))
+			print("\t\t" + " -> ".join(path))
 
 	if Print_All_Funcs:
 		print("Funcs:")
@@ -145,56 +273,370 @@ def main():
 	if Print_Line_Counts:
 		print("Lines of code: %d Number of bytes: %d Number of files: %d" % (total_lines, total_bytes, total_files))
 
-def find_funcs(path, funcs, used_funcs = None):
-	line_num = 0
-	funcname = ""
+# Analyse each file, with jobs worker processes if more than one,
+# yielding (path, result) in the order of paths, whatever order the
+# workers finish in, so that merging the results gives the same output
+# however many jobs there are. See analyse_file() for the result.
+# Files whose fingerprints match their entries in the cache aren't
+# analysed again; their cached results are used instead.
+def analyse_files(paths, jobs, cache = {}, fingerprints = {}):
+	stale = []
+	for path in paths:
+		if not is_cached(cache, fingerprints, path):
+			stale.append(path)
+	results = analyse_stale_files(stale, jobs)
+	for path in paths:
+		if is_cached(cache, fingerprints, path):
+			yield path, cache[path][1]
+		else:
+			yield path, next(results)
+
+def is_cached(cache, fingerprints, path):
+	return path in cache and fingerprints.get(path) is not None and cache[path][0] == fingerprints[path]
+
+def analyse_stale_files(paths, jobs):
+	if jobs <= 1:
+		for path in paths:
+			yield analyse_file(path)
+		return
+	chunksize = max(1, len(paths) // (jobs * 16))
+	with multiprocessing.Pool(jobs, set_options, (get_options(), Index_Paths)) as pool:
+		for result in pool.imap(analyse_file, paths, chunksize):
+			yield result
+
+# The parts of each file's stat results which change when its content does,
+# or None for files which can't be stat'ed (and so are always analysed).
+def get_fingerprints(paths):
+	fingerprints = {}
+	for path in paths:
+		try:
+			status = os.stat(path)
+			fingerprints[path] = (status.st_size, status.st_mtime_ns)
+		except OSError:
+			fingerprints[path] = None
+	return fingerprints
+
+# Read the cache of each file's fingerprint and results: path -> (fingerprint, result).
+# It's empty if missing or unreadable, or if written by a different
+# version or with different options, whose results may differ.
+def read_cache(cache_path):
+	try:
+		f = open(cache_path, "rb")
+		if pickle.load(f) != (CACHE_VERSION, get_options()):
+			return {}
+		return pickle.load(f)
+	except Exception:
+		return {}
+
+# Replace the cache. Files modified too recently to be sure of noticing
+# further changes within the same clock tick are left out.
+def write_cache(cache_path, cache):
+	racy_ns = time.time_ns() - CACHE_RACY_NS
+	entries = {}
+	for path in cache:
+		fingerprint, result = cache[path]
+		if fingerprint is None or fingerprint[1] >= racy_ns:
+			continue
+		entries[path] = (fingerprint, result)
+	temp = cache_path + ".tmp"
+	try:
+		f = open(temp, "wb")
+		pickle.dump((CACHE_VERSION, get_options()), f, pickle.HIGHEST_PROTOCOL)
+		pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+		f.close()
+		os.replace(temp, cache_path)
+	except (IOError, OSError):
+		print("Cannot write cache: " + cache_path)
+
+# The options which analyse_file() depends on, to pass to worker processes,
+# which may not inherit them. Index_Paths isn't among them, since the
+# sites of uses aren't cached.
+def get_options():
+	return (Ignore_Test_Funcs, Print_Import_Cycles, Print_Unused_Funcs, Print_Unused_Types, Print_Unused_Vars, Find_Unreachable)
+
+def set_options(options, index_paths = set()):
+	global Ignore_Test_Funcs, Print_Import_Cycles, Print_Unused_Funcs, Print_Unused_Types, Print_Unused_Vars, Find_Unreachable
+	global Index_Paths
+	(Ignore_Test_Funcs, Print_Import_Cycles, Print_Unused_Funcs, Print_Unused_Types, Print_Unused_Vars, Find_Unreachable) = options
+	Index_Paths = index_paths
+
+# Open the index, creating its tables if need be. They're made again,
+# empty, if made by a different version, or with different options
+# which affect the rows written.
+def open_index(index_path):
+	try:
+		index = sqlite3.connect(index_path)
+		index.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+		options = repr((INDEX_VERSION, Ignore_Test_Funcs, Print_Import_Cycles))
+		row = index.execute("SELECT value FROM meta WHERE key = 'options'").fetchone()
+		if row is None or row[0] != options:
+			for table in ("files", "decls", "uses", "imports"):
+				index.execute("DROP TABLE IF EXISTS " + table)
+			for statement in Index_Tables:
+				index.execute(statement)
+			index.execute("INSERT OR REPLACE INTO meta VALUES ('options', ?)", (options,))
+		return index
+	except sqlite3.Error as err:
+		print("Cannot open index: " + index_path + ": " + str(err))
+		return None
+
+# The fingerprint of each file in the index when its rows were written,
+# or None if it was modified too recently to be sure of noticing further
+# changes within the same clock tick (so it's always written again).
+def read_indexed_files(index):
+	indexed = {}
+	for path, size, mtime_ns in index.execute("SELECT path, size, mtime_ns FROM files"):
+		indexed[path] = None
+		if size is not None:
+			indexed[path] = (size, mtime_ns)
+	return indexed
+
+# Replace a file's rows in the index with those from its results.
+def index_file(index, path, fingerprint, result):
+	num_lines, num_bytes, funcs, types, vars, import_pairs, uses, refs, sites = result
+	unindex_file(index, path)
+
+	if fingerprint is None or fingerprint[1] >= time.time_ns() - CACHE_RACY_NS:
+		fingerprint = (None, None)
+	cursor = index.execute("INSERT INTO files (path, size, mtime_ns, lines, bytes) VALUES (?, ?, ?, ?, ?)", (path,) + fingerprint + (num_lines, num_bytes))
+	file_id = cursor.lastrowid
+
+	rows = []
+	for funcname in funcs:
+		for func_decl in funcs[funcname]:
+			decl_path, line_num, receiver_type, name = func_decl
+			rows.append((name, "func", receiver_type, file_id, line_num))
+	for typename in types:
+		for type_decl in types[typename]:
+			decl_path, line_num, name = type_decl
+			rows.append((name, "type", "", file_id, line_num))
+	for varname in vars:
+		for var_decl in vars[varname]:
+			decl_path, line_num, name = var_decl
+			rows.append((name, "var", "", file_id, line_num))
+	index.executemany("INSERT INTO decls (name, kind, receiver, file, line) VALUES (?, ?, ?, ?, ?)", rows)
+
+	index.executemany("INSERT INTO uses VALUES (?, ?, ?)", [(name, file_id, line_num) for line_num, name in sites])
+	index.executemany("INSERT INTO imports VALUES (?, ?, ?)", [(packagename, child, file_id) for packagename, child in import_pairs])
+
+# Remove the rows of files which are no longer there.
+def unindex_removed_files(index, indexed, paths):
+	for path in indexed:
+		if path not in paths:
+			unindex_file(index, path)
+
+def unindex_file(index, path):
+	row = index.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+	if row is None:
+		return
+	for table in ("decls", "uses", "imports"):
+		index.execute("DELETE FROM " + table + " WHERE file = ?", row)
+	index.execute("DELETE FROM files WHERE id = ?", row)
+
+# Mark which declarations of a kind are used (or reachable, with
+# --find-unreachable), according to the report of unused ones, or
+# leave it NULL if there was no such report.
+def index_used(index, kind, used, reported):
+	if not reported:
+		index.execute("UPDATE decls SET used = NULL WHERE kind = ?", (kind,))
+		return
+	index.execute("CREATE TEMP TABLE IF NOT EXISTS used_names (name TEXT PRIMARY KEY)")
+	index.execute("DELETE FROM used_names")
+	index.executemany("INSERT INTO used_names VALUES (?)", [(name,) for name in used])
+	index.execute("UPDATE decls SET used = (name IN (SELECT name FROM used_names)) WHERE kind = ?", (kind,))
+
+# Everything needed from one file, in one pass over its source:
+# (num_lines, num_bytes, funcs, types, vars, import_pairs, uses, refs, sites)
+# where funcs, types and vars are its declarations (as find_funcs() etc.
+# return them), import_pairs are its imports (see iter_imports()),
+# uses are the words it uses (see find_uses()), refs are the words
+# each declaration refers to (see find_refs()), for --find-unreachable,
+# and sites are the sites of its uses (see find_sites()), for --index.
+def analyse_file(path):
+	source = lex_source(path)
+	num_lines, num_bytes = count_lines_and_bytes(source)
+	funcs = find_funcs(path, source, {})
+	types = find_types(path, source, {})
+	vars  = find_vars(path, source, {})
+	import_pairs = []
+	if Print_Import_Cycles:
+		import_pairs = list(iter_imports(source))
+	uses = (set(), set(), set())
+	refs = ({}, set())
+	if Print_Unused_Funcs or Print_Unused_Types or Print_Unused_Vars:
+		if Find_Unreachable:
+			refs = find_refs(source)
+		else:
+			uses = find_uses(source)
+	sites = None
+	if path in Index_Paths:
+		sites = find_sites(source)
+	return num_lines, num_bytes, funcs, types, vars, import_pairs, uses, refs, sites
+
+# Add one file's declarations to all of them.
+def merge_decls(all_decls, decls):
+	for name in decls:
+		if name not in all_decls:
+			all_decls[name] = []
+		all_decls[name].extend(decls[name])
+
+# Read a source file, returning a record of each of its lines:
+# (line, words) where words are the names and such on the line,
+# as split_code() finds them. All the analyses below scan this.
+def lex_source(path):
+	source = []
 	for line in open(path):
-		line_num += 1
-
+		source.append((line, split_code(line)))
+	return source
+
+# Find the words which count as uses in a source file, returning
+# (func_words, type_words, var_words): the words on lines which don't
+# declare a func (other than the name of the func each line is within,
+# since funcs calling themselves don't count), type or var, respectively.
+def find_uses(source):
+	func_words = set()
+	type_words = set()
+	var_words  = set()
+	funcname = ""
+	for line, words in source:
 		if line[:1] == "}":						# End-of-func resets which funcname we're within.
 			funcname = ""
 
-		line_has_func_decl = (line[:5] == "func ")
-
-		if not line_has_func_decl:
-			# Line is not a func declaration.
-			if used_funcs != None:
-				# Perform func-call/func-use analysis only on lines which are not func declarations.
-				for name in funcs:
-					if name == funcname:				# Ignore funcs calling themselves.
-						continue
-					if name not in line:				# Fast approximate check.
-						continue
-					if name not in split_code(line):	# Slow accurate check.
-						continue
-					if name not in used_funcs:
-						used_funcs[name] = []
-					used_funcs[name].append((path, line_num))
-			# When looking for usage, don't add func decl again.
-			continue
+		words = set(words)
+		if line[:5] == "func ":
+			func_decl = parse_func_decl(line)
+			if func_decl:
+				receiver_type, funcname = func_decl
+		elif funcname in words:
+			func_words.update(words - {funcname})
+		else:
+			func_words.update(words)
+		if line[:5] != "type ":
+			type_words.update(words)
+		if line[:4] != "var ":
+			var_words.update(words)
+
+	return func_words, type_words, var_words
+
+# Find which of the declared names are used, given each file's words
+# of the kind used (an index into each file's uses, see find_uses()).
+def find_used(decls, all_uses, kind):
+	words = set()
+	for path in all_uses:
+		words.update(all_uses[path][kind])
+	return decls.keys() & words
+
+# Find the sites of uses in a source file, for the index: (line_num, name)
+# for each name on each line, other than Go's keywords and predeclared
+# names, and those declared on the line.
+def find_sites(source):
+	sites = []
+	line_num = 0
+	for line, words in source:
+		line_num += 1
+		declared = get_decl_names(line)
+		for word in dict.fromkeys(words):
+			if word in Go_Names or word in declared or not word.isidentifier():
+				continue
+			sites.append((line_num, word))
+	return sites
+
+# Find the words which each declaration in a source file refers to,
+# returning (refs, root_words): refs maps each declared name to the words
+# on its declaration's lines, and root_words are those on lines outside
+# any declaration (e.g. consts, "var (" and "type (" blocks), which are
+# taken to refer to whatever they name from an entry point. A declaration
+# runs from its first line to a line starting with "}" or ")" which
+# doesn't itself open a block (as the end of a multi-line signature
+# does), unless its first line doesn't end by opening a block. Comments,
+# package clauses and imports outside declarations are left out.
+def find_refs(source):
+	refs = {}
+	root_words = set()
+	owners = []
+	for line, words in source:
+		decl_end = 0
+		if line[:5] in ("func ", "type ") or line[:4] == "var ":
+			owners = get_decl_names(line)
+			decl_end = line.rstrip()[-1:] not in ("{", "(")
+		elif line[:1] in ("}", ")"):
+			decl_end = line.rstrip()[-1:] not in ("{", "(")
+
+		if owners:
+			for name in owners:
+				if name not in refs:
+					refs[name] = set()
+				refs[name].update(words)
+		elif not has_prefix(line.lstrip(), ["//", "package ", "import "]):
+			root_words.update(words)
+
+		if decl_end:
+			owners = []
+
+	return refs, root_words
+
+# Find which of the declared names are reachable from the entry points
+# (see is_root_name()) and the words outside declarations, following the
+# references each name's declarations make (see find_refs()) to other
+# declared names, in a breadth-first search.
+def find_reachable(decl_names, all_refs):
+	graph = {}
+	reachable = set()
+	for path in all_refs:
+		refs, root_words = all_refs[path]
+		reachable.update(root_words & decl_names)
+		for name in refs:
+			if name not in graph:
+				graph[name] = set()
+			graph[name].update(refs[name] & decl_names)
+	for name in decl_names | graph.keys():
+		if is_root_name(name):
+			reachable.add(name)
+
+	level = list(reachable)
+	while level:
+		below = []
+		for name in level:
+			for child in graph.get(name, ()):
+				if child not in reachable:
+					reachable.add(child)
+					below.append(child)
+		level = below
+	return reachable
+
+# Entry points: funcs Go calls (main, init and those go test runs),
+# and exported names, which code outside those analysed may use.
+def is_root_name(name):
+	return name in Root_Names or has_prefix(name, Root_Prefixes) or name[:1].isupper()
+
+# The names declared on a line (a func, type or var declaration).
+def get_decl_names(line):
+	if line[:5] == "func ":
+		func_decl = parse_func_decl(line)
+		if func_decl:
+			return [func_decl[1]]
+		return []
+	if line[:5] == "type ":
+		typename = parse_type_decl(line)
+		if typename == "(":
+			return []						# A "type (" block, like "var ("
+		return [typename]
+	if line[:4] == "var ":
+		return parse_var_decl(line)
+	return []
+
+def find_funcs(path, source, funcs):
+	line_num = 0
+	for line, words in source:
+		line_num += 1
 
-		line = line[5:]							# Trim "func "
+		if line[:5] != "func ":
+			continue
 
-		# Look for a receiver.
-		receiver_type = ""
-		if line[:1] == "(":						# Found start of receiver.
-			line = line[1:]						# Trim "("
-			pos = line.find(")")
-			if pos < 0:							# Cannot understand func declaration.
-				continue
-			receiver_decl = line[:pos].split()
-			if len(receiver_decl) < 1:			# Cannot understand receiver declaration.
-				continue
-			receiver_type = receiver_decl[-1]	# Keep receiver type.
-			line = line[pos+1:]					# Trim receiver and ")"
-
-		# Look for parameter list.
-		pos = line.find("(")
-		if pos < 0:
-			pos = len(line)
-		funcname = line[:pos].strip()
-		if used_funcs != None:					# Analysing usage; set funcname then continue.
+		func_decl = parse_func_decl(line)
+		if not func_decl:						# Cannot understand func declaration.
 			continue
+		receiver_type, funcname = func_decl
 		if Ignore_Test_Funcs and funcname[:4] == "Test":
 			continue
 		if funcname not in funcs:
@@ -204,36 +646,40 @@ def find_funcs(path, funcs, used_funcs = None):
 
 	return funcs
 
-def find_types(path, types, used_types = None):
+# Parse a line starting "func ", returning (receiver_type, funcname),
+# or None if it cannot be understood.
+def parse_func_decl(line):
+	line = line[5:]							# Trim "func "
+
+	# Look for a receiver.
+	receiver_type = ""
+	if line[:1] == "(":						# Found start of receiver.
+		line = line[1:]						# Trim "("
+		pos = line.find(")")
+		if pos < 0:							# Cannot understand func declaration.
+			return None
+		receiver_decl = line[:pos].split()
+		if len(receiver_decl) < 1:			# Cannot understand receiver declaration.
+			return None
+		receiver_type = receiver_decl[-1]	# Keep receiver type.
+		line = line[pos+1:]					# Trim receiver and ")"
+
+	# Look for parameter list.
+	pos = line.find("(")
+	if pos < 0:
+		pos = len(line)
+	funcname = line[:pos].strip()
+	return receiver_type, funcname
+
+def find_types(path, source, types):
 	line_num = 0
-	for line in open(path):
+	for line, words in source:
 		line_num += 1
 
-		line_has_type_decl = (line[:5] == "type ")
-
-		if used_types != None:
-			# Perform usage anaylsis.
-			if not line_has_type_decl:
-				# Perform type-use analysis only on lines which are not type declarations.
-				for name in types:
-					if name not in line:				# Fast approximate check.
-						continue
-					if name not in split_code(line):	# Slow accurate check.
-						continue
-					# Record usage.
-					if name not in used_types:
-						used_types[name] = []
-					used_types[name].append((path, line_num))
-			# When looking for usage, don't add type decl again.
+		if line[:5] != "type ":
 			continue
 
-		if not line_has_type_decl:
-			continue
-
-		line = line[5:]							# Trim "type "
-
-		# Look for type name.
-		typename = line.split()[0]
+		typename = parse_type_decl(line)
 		if typename not in types:
 			types[typename] = []
 		data = (path, line_num, typename)
@@ -241,39 +687,15 @@ def find_types(path, types, used_types = None):
 
 	return types
 
-def find_vars(path, vars, used_vars = None):
+def find_vars(path, source, vars):
 	line_num = 0
-	for line in open(path):
+	for line, words in source:
 		line_num += 1
 
-		line_has_var_decl = (line[:4] == "var ")
-
-		if used_vars != None:
-			# Perform usage analysis.
-			if not line_has_var_decl:
-				# Perform global var-use analysis only on lines which are not var declarations.
-				for name in vars: 
-					if name not in line:				# Fast approximate check.
-						continue
-					if name not in split_code(line):	# Slow accurate check.
-						continue
-					# Record usage.
-					if name not in used_vars:
-						used_vars[name] = []
-					used_vars[name].append((path, line_num))
-			# When looking for usage, don't add var decl again.
-			continue
-
-		if not line_has_var_decl:
+		if line[:4] != "var ":
 			continue
 
-		line = line[4:]							# Trim "var "
-
-		# Look for var name.
-		parts = split_vars(line)
-		for varname in parts:
-			if varname == "(":
-				continue						# Ignore "var ("
+		for varname in parse_var_decl(line):
 			if varname not in vars:
 				vars[varname] = []
 			data = (path, line_num, varname)
@@ -281,54 +703,128 @@ def find_vars(path, vars, used_vars = None):
 
 	return vars
 
-def topological_sort(children):  # children maps each item to a set of its child items
-	# Kahn's algorithm
-
-	parents = form_parent_mapping(children)
-
-	starters = set()
-	for child in parents:
-		if len(parents[child]) == 0:
-			starters.add(child)
-	for start in starters:
-		del parents[start]
-
-	sorted_list = []
-	while len(starters) != 0:
-		start = starters.pop()
-		sorted_list.append(start)
-
-		if start in children:
-			for child in children[start]:
-				parents[child].remove(start)
-		if child in parents and len(parents[child]) == 0:
-			starters.add(child)
-			del parents[child]
-
-	err = None
-	if len(parents) > 0:
-		err = ("Error: cycle in graph", parents)
-
-	return sorted_list, err
-
-def form_parent_mapping(children):
+# Parse a line starting "type ", returning the type's name.
+def parse_type_decl(line):
+	line = line[5:]							# Trim "type "
+
+	# Look for type name.
+	return line.split()[0]
+
+# Parse a line starting "var ", returning the names of its vars.
+def parse_var_decl(line):
+	line = line[4:]							# Trim "var "
+
+	# Look for var names.
+	varnames = []
+	for varname in split_vars(line):
+		if varname == "(":
+			continue						# Ignore "var ("
+		varnames.append(varname)
+	return varnames
+
+# Find every cycle in a graph, given as a mapping of each node to the set
+# of its children. Returns a list of (cycle, path) for each strongly
+# connected component with a cycle, where cycle is its nodes, sorted,
+# and path is one of its cycles: a list of nodes, each a child of the one
+# before, starting and ending with the first node in cycle.
+def find_cycles(children):
+	cycles = []
+	for component in find_strongly_connected_components(children):
+		node = component[0]
+		if len(component) > 1 or node in children.get(node, ()):
+			cycles.append((component, find_path(children, set(component), node, node)))
+	cycles.sort()
+	return cycles
+
+# Tarjan's algorithm, iteratively, so deep graphs don't exceed the
+# recursion limit. Returns a list of components, each a sorted list of
+# nodes. Nodes and children are visited in sorted order, so the result
+# doesn't depend on the order of the sets.
+def find_strongly_connected_components(children):
+	nodes = set(children)
+	for node in children:
+		nodes.update(children[node])
+
+	index = {}								# Order in which each node was visited.
+	lowlink = {}							# Lowest index reachable from each node's subtree.
+	stack = []								# Visited nodes not yet assigned to a component.
+	on_stack = set()
+	components = []
+	for root in sorted(nodes):
+		if root in index:
+			continue
+		index[root] = lowlink[root] = len(index)
+		stack.append(root)
+		on_stack.add(root)
+		work = [(root, iter(sorted(children.get(root, ()))))]
+		while work:
+			node, unvisited = work[-1]
+			for child in unvisited:
+				if child not in index:		# Visit child, then come back for node's next child.
+					index[child] = lowlink[child] = len(index)
+					stack.append(child)
+					on_stack.add(child)
+					work.append((child, iter(sorted(children.get(child, ())))))
+					break
+				if child in on_stack:
+					lowlink[node] = min(lowlink[node], index[child])
+			else:							# Done with node's children.
+				work.pop()
+				if work:
+					parent = work[-1][0]
+					lowlink[parent] = min(lowlink[parent], lowlink[node])
+				if lowlink[node] == index[node]:
+					component = []
+					while True:
+						member = stack.pop()
+						on_stack.discard(member)
+						component.append(member)
+						if member == node:
+							break
+					components.append(sorted(component))
+	return components
+
+# Find a shortest path from start to end, through only the given nodes,
+# by a breadth-first search. The path has at least one edge, so if start
+# is end it's a cycle. Returns the list of nodes on the path, or None.
+def find_path(children, nodes, start, end):
 	parents = {}
-	for key in children:
-		parents[key] = set()
-	for key in children:
-		for child in children[key]:
-			if child not in parents:
-				parents[child] = set()
-			parents[child].add(key)
-	return parents
-
-def find_imports(path, imports, ignore=None):
-	lines = open(path).readlines()
+	level = [start]
+	while level:
+		below = []
+		for node in level:
+			for child in sorted(children.get(node, ())):
+				if child not in nodes or child in parents:
+					continue
+				parents[child] = node
+				if child == end:
+					path = [end]
+					while len(path) == 1 or path[-1] != start:
+						path.append(parents[path[-1]])
+					path.reverse()
+					return path
+				below.append(child)
+		level = below
+	return None
+
+# Add imports, as iter_imports() finds them, to the mapping of each
+# package to the set of packages it imports.
+def find_imports(import_pairs, imports, ignore=None):
+	for packagename, child in import_pairs:
+		if packagename not in imports:
+			imports[packagename] = set()
+		if ignore and ignore(child):
+			continue
+		imports[packagename].add(child)
+	return imports
+
+# Yield (packagename, child) for each import in a source file.
+def iter_imports(source):
 	mode = ""
 	packagename = ""
-	for line in lines:
-		if line[:9] == 'package ':
-			packagename = line[9:].strip()
+	for line, words in source:
+		if line[:8] == 'package ':
+			packagename = (line[8:].split() + [""])[0]	# Ignore any comment after the name.
 			if packagename[-1:] == ';':
 				packagename = packagename[:-1]
 			continue
@@ -367,12 +863,7 @@ def find_imports(path, imports, ignore=None):
 			if child[-1:] == '`': child = child[:-1]
 		if not child:
 			continue
-		if packagename not in imports:
-			imports[packagename] = set()
-		if ignore and ignore(child):
-			continue
-		imports[packagename].add(child)
-	return imports
+		yield packagename, child
 
 def importpath_to_packagename(path):
 	if '/' in path:
@@ -424,6 +915,23 @@ Golang_stdlib = {
 	"unsafe",
 }
 
+Go_Keywords = {
+	"break", "case", "chan", "const", "continue", "default", "defer", "else",
+	"fallthrough", "for", "func", "go", "goto", "if", "import", "interface",
+	"map", "package", "range", "return", "select", "struct", "switch", "type", "var",
+}
+
+Go_Predeclared = {
+	"any", "bool", "byte", "comparable", "complex64", "complex128", "error",
+	"float32", "float64", "int", "int8", "int16", "int32", "int64", "rune",
+	"string", "uint", "uint8", "uint16", "uint32", "uint64", "uintptr",
+	"true", "false", "iota", "nil",
+	"append", "cap", "clear", "close", "complex", "copy", "delete", "imag",
+	"len", "make", "max", "min", "new", "panic", "print", "println", "real", "recover",
+}
+
+Go_Names = Go_Keywords | Go_Predeclared
+
 def ignore_Golang_stdlib(path):
 	if path in Golang_stdlib:
 		return True
@@ -432,10 +940,10 @@ def ignore_Golang_stdlib(path):
 def ignore_common_paths(path):
 	return ignore_paths_with_slash(path) or ignore_Golang_stdlib(path)
 
-def count_lines_and_bytes(path):
+def count_lines_and_bytes(source):
 	num_lines = 0
 	num_bytes = 0
-	for line in open(path):
+	for line, words in source:
 		num_lines += 1
 		num_bytes += len(line)
 	return num_lines, num_bytes